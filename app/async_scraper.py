@@ -0,0 +1,386 @@
+import asyncio
+import http.client
+import io
+import os
+import ssl
+import time
+from urllib.parse import urlencode, urlsplit
+
+from bpl_scraper import SCRAPE_RETRIES, bpl_url
+from compressed import open_text
+from http_scraper import STALE_CONNECTION_ERRORS, WebFormsSession
+
+"""
+Scraping with asyncio, for when the network is all that's left to wait on.
+
+Each search session is a WebFormsSession with its own keep-alive connection,
+carrying its own __VIEWSTATE from page to page, and a fixed number of them take
+search terms off a queue. Every request waits its turn with one RateLimiter
+shared between the sessions, so the site sees no more than so many requests a
+second however many sessions there are. Entries go to a single writer task,
+which puts them in the file in search order as soon as everything before them
+has arrived.
+"""
+
+# How many search sessions to run at once
+SESSIONS = 8
+
+# Seconds a search term gets, every page of it, before it's given up on and tried again
+TERM_TIMEOUT = 120
+
+
+class RateLimiter:
+    """
+    Spaces requests out so there are no more than rate a second, across every session
+    which shares it
+    """
+
+    def __init__(self, rate=None):
+        """
+        :param rate: Requests per second, or None for as fast as they'll go
+        """
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+
+        # Nothing else runs between here and the sleep, so no lock is needed
+        now = asyncio.get_running_loop().time()
+        wait = self._next - now
+        self._next = max(now, self._next) + self.interval
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ScrapeStats:
+    """
+    How long each request took, not counting time spent waiting on the rate limiter
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.start = time.perf_counter()
+        self.end = None
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def requests_per_second(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0
+
+    def percentile(self, p):
+        """
+        :param p: Between 0 and 100
+        :return: The latency in seconds which p percent of requests took no longer than
+        """
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, max(0, -(-len(latencies) * p // 100) - 1))]
+
+    def __str__(self):
+        return (f"{len(self.latencies)} requests in {self.elapsed:.1f}s, {self.requests_per_second:.1f} req/s, "
+                f"p50 {self.percentile(50) * 1000:.0f} ms, p95 {self.percentile(95) * 1000:.0f} ms")
+
+
+class AsyncConnection:
+    """
+    Just enough of HTTP/1.1 over asyncio streams for talking to one host, keeping
+    the connection alive between requests
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.netloc = parts.netloc
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, headers, body=None):
+        """
+        :param body: Bytes, if there is one
+        :return: The status, reason, headers as an http.client.HTTPMessage, and body
+        """
+        while True:
+            reused = self._writer is not None
+            if not reused:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port, ssl=ssl.create_default_context() if self.https else None
+                )
+
+            try:
+                return await self._exchange(method, path, headers, body)
+            except STALE_CONNECTION_ERRORS + (asyncio.IncompleteReadError,):
+                self.close()
+                if not reused:
+                    raise
+            except BaseException:
+                # Including being cancelled partway through, which leaves the connection in a state
+                self.close()
+                raise
+
+    async def _exchange(self, method, path, headers, body):
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.netloc}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before a response")
+        _, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+        header_lines = []
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line)
+        response_headers = http.client.parse_headers(io.BytesIO(b"".join(header_lines) + b"\r\n"))
+
+        if (response_headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                if not size:
+                    # The trailers, if any, finished by a blank line
+                    while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readexactly(2)
+            data = b"".join(chunks)
+        elif response_headers.get("Content-Length") is not None:
+            data = await self._reader.readexactly(int(response_headers["Content-Length"]))
+        else:
+            data = await self._reader.read()
+            self.close()
+
+        if (response_headers.get("Connection") or "").lower() == "close":
+            self.close()
+
+        return int(status), reason, response_headers, data
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+
+class AsyncWebFormsSession(WebFormsSession):
+    """
+    A WebFormsSession whose requests are awaited, over its own connection rather
+    than the pool
+    """
+
+    def __init__(self, url=bpl_url, limiter=None, stats=None):
+        """
+        :param limiter: A RateLimiter shared with the other sessions
+        :param stats: A ScrapeStats to record each request in
+        """
+        super().__init__(url)
+        self.connection = AsyncConnection(url)
+        self.limiter = RateLimiter() if limiter is None else limiter
+        self.stats = stats
+
+    async def open(self):
+        self.load(await self.request("GET", self.url))
+
+    async def request(self, method, url, body=None):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        headers = self.headers(body)
+        if body is not None:
+            body = body.encode("utf-8")
+
+        await self.limiter.acquire()
+
+        start = time.perf_counter()
+        status, reason, response_headers, data = await self.connection.request(method, path, headers, body)
+        if self.stats is not None:
+            self.stats.record(time.perf_counter() - start)
+
+        self.requests += 1
+
+        return self.read_response(method, url, status, reason, response_headers, data)
+
+    async def submit(self, fields):
+        self.load(await self.request("POST", self.action, urlencode(fields)))
+
+    async def search(self, search_term):
+        await self.submit(self.search_fields(search_term))
+
+    async def postback(self, target, argument):
+        await self.submit(self.postback_fields(target, argument))
+
+    async def go_to_page(self, page_number):
+        if page_number not in self.results.targets:
+            return False
+
+        await self.postback(*self.results.targets[page_number])
+        return True
+
+    def quit(self):
+        self.connection.close()
+        self.page = None
+        self.results = None
+
+
+async def scrape_from_all_pages(session, search_term):
+    """
+    Collect entries from every page of the search result, the same way
+    http_scraper.scrape_from_all_pages does
+    """
+    await session.search(search_term)
+
+    for page_number in session.pages_back_to_first():
+        await session.go_to_page(page_number)
+
+    entries = list(session.results.rows)
+
+    for page_number in session.pages_after():
+        await session.go_to_page(page_number)
+        entries += session.results.rows
+
+    return entries
+
+
+async def scrape_session(terms, results, failures, url, limiter, stats, timeout, retries):
+    """
+    Take search terms off the queue until it's empty, putting each one's entries on
+    results, or None if it couldn't be scraped
+
+    A term which fails or runs out of time is tried again with a new session, since
+    the old one's state can't be trusted after that
+    """
+    session = None
+
+    try:
+        while True:
+            try:
+                search_term = terms.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            entries = None
+            for attempt in range(retries + 1):
+                try:
+                    if session is None:
+                        session = AsyncWebFormsSession(url, limiter, stats)
+                        await asyncio.wait_for(session.open(), timeout)
+                    entries = await asyncio.wait_for(scrape_from_all_pages(session, search_term), timeout)
+                    failures.pop(search_term, None)
+                    break
+                except Exception as e:
+                    failures[search_term] = e
+                    if session is not None:
+                        session.quit()
+                        session = None
+
+            await results.put((search_term, entries))
+    finally:
+        if session is not None:
+            session.quit()
+
+
+async def write_results(search_terms, results, filepath, log=True):
+    """
+    Write entries to filepath in the order of search_terms, however they arrive.
+    Once a term has failed nothing more is written, since the file won't be kept
+    """
+    order = {search_term: i for i, search_term in enumerate(search_terms)}
+    waiting = {}
+    next_term = 0
+    failed = False
+
+    with open_text(filepath, "w") as f:
+        for _ in search_terms:
+            search_term, entries = await results.get()
+            waiting[order[search_term]] = entries
+
+            while next_term in waiting:
+                entries = waiting.pop(next_term)
+
+                if entries is None:
+                    failed = True
+                elif failed:
+                    pass
+                elif entries:
+                    for entry in entries:
+                        if log:
+                            print(entry)
+                        f.write("\t".join(entry) + "\n")
+                elif log:
+                    print(f"No entries for {search_terms[next_term]}")
+
+                next_term += 1
+
+
+async def scrape_to_file_async(search_terms, filepath, sessions=SESSIONS, rate_limit=None, timeout=TERM_TIMEOUT,
+                               retries=SCRAPE_RETRIES, url=bpl_url, log=True):
+    """
+    See scrape_to_file
+    """
+    terms = asyncio.Queue()
+    for search_term in search_terms:
+        terms.put_nowait(search_term)
+
+    results = asyncio.Queue()
+    failures = {}
+    limiter = RateLimiter(rate_limit)
+    stats = ScrapeStats()
+
+    writer = asyncio.ensure_future(write_results(search_terms, results, filepath, log))
+    await asyncio.gather(*[
+        scrape_session(terms, results, failures, url, limiter, stats, timeout, retries)
+        for _ in range(max(sessions, 1))
+    ])
+    await writer
+
+    stats.stop()
+
+    if failures:
+        os.remove(filepath)
+        for search_term, error in failures.items():
+            print(f"Failed to scrape {search_term}: {error!r}")
+        raise ValueError(f"Could not scrape {len(failures)} search terms, not saving {filepath}")
+
+    if log:
+        print(stats)
+
+    return stats
+
+
+def scrape_to_file(search_terms, filepath, sessions=SESSIONS, rate_limit=None, timeout=TERM_TIMEOUT,
+                   retries=SCRAPE_RETRIES, url=bpl_url, log=True):
+    """
+    Scrape each search term over HTTP with a number of sessions at once, writing the
+    entries to filepath in the order of search_terms. If any term can't be scraped
+    the file is deleted and a ValueError raised
+
+    :param sessions: How many search sessions to have going at once
+    :param rate_limit: The most requests a second between all the sessions, or None for no limit
+    :param timeout: Seconds each search term gets, including waiting on the rate limiter
+    :param retries: How many more times to try a search term which fails
+    :return: A ScrapeStats with the request rate and latencies
+    """
+    return asyncio.run(scrape_to_file_async(search_terms, filepath, sessions, rate_limit, timeout, retries, url, log))
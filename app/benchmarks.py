@@ -0,0 +1,248 @@
+import contextlib
+import gc
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from async_scraper import scrape_to_file
+import bpl_scraper
+from bpl_scraper import BACKENDS, letter_combos, pull_current_page, pull_entries_from_page, scrape_all_data
+from compressed import CODECS, compressed_name, open_text
+from diffy import EntryList, DiffEntryHistory
+from mock_bpl import MockBplServer, generate_officers, render_page
+from results_parser import browser_text, parse_results_page
+
+"""
+Rough measurements of how the differencing library performs on a real archive,
+and how fast the scrapers go against mock_bpl's stand-in for the search page.
+
+These are meant to be run by hand against the sample repo, eg
+
+    python app/benchmarks.py
+"""
+
+
+def measure_entry_memory(filepath, log=True):
+    """
+    Measure how many bytes of memory each Entry costs once loaded into an EntryList,
+    counting the strings it holds as well as the object itself
+
+    :param filepath: A snapshot TSV such as sample_repo/scrape/20211101.tsv
+    :return: The number of bytes per entry
+    """
+    gc.collect()
+    tracemalloc.start()
+
+    entry_list = EntryList.open(filepath)
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bytes_per_entry = current / len(entry_list)
+
+    if log:
+        print(f"{len(entry_list)} entries loaded from {filepath}")
+        print(f"{bytes_per_entry:.0f} bytes per entry resident, {peak / len(entry_list):.0f} at peak")
+
+    return bytes_per_entry
+
+
+def compare_codecs(repo="sample_repo", log=True):
+    """
+    Copy repo once per codec in compressed.CODECS, compressing every TSV, and time
+    loading each copy back: a scrape with EntryList.open, and the whole diff
+    directory with DiffEntryHistory.open and rebuild
+
+    :return: A dict of codec extension (None for uncompressed): (bytes on disk,
+    seconds to load the scrapes, seconds to rebuild)
+    """
+    results = {}
+    work = tempfile.mkdtemp()
+
+    try:
+        for compression in [None] + list(CODECS):
+            copy = f"{work}/{compression or 'plain'}"
+
+            for folder in ("scrape", "diff"):
+                os.makedirs(f"{copy}/{folder}")
+
+                for filename in os.listdir(f"{repo}/{folder}"):
+                    source = f"{repo}/{folder}/{filename}"
+
+                    if filename.endswith(".txt"):
+                        shutil.copy(source, f"{copy}/{folder}/{filename}")
+                    elif filename.endswith(".tsv") and not filename.startswith("_"):
+                        # Snapshots and differences, leaving out the head and indexes
+                        target = compressed_name(f"{copy}/{folder}/{filename}", compression)
+                        with open(source, "r") as f, open_text(target, "w") as output:
+                            shutil.copyfileobj(f, output)
+
+            size = sum(
+                os.path.getsize(f"{root}/{filename}") for root, _, filenames in os.walk(copy) for filename in filenames
+            )
+
+            start = time.perf_counter()
+            for filename in sorted(os.listdir(f"{copy}/scrape")):
+                EntryList.open(f"{copy}/scrape/{filename}")
+            scrape_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            DiffEntryHistory.open(f"{copy}/diff").rebuild()
+            rebuild_time = time.perf_counter() - start
+
+            results[compression] = (size, scrape_time, rebuild_time)
+
+            if log:
+                print(f"{compression or 'none':>5}: {size / 1e6:7.2f} MB, "
+                      f"scrapes load in {scrape_time:.3f}s, rebuild in {rebuild_time:.3f}s")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return results
+
+
+def async_scrape_throughput(officers=5000, latency=0.02, sessions=(1, 4, 16), rate_limit=None, log=True):
+    """
+    Scrape a mock_bpl.MockBplServer with the async backend, once for each number of
+    sessions. The latency stands in for the round trip to the real site, which is
+    what the sessions are there to hide
+
+    :param officers: How many made up officers the mock serves
+    :param latency: Seconds the mock waits before each response
+    :return: A dict of sessions: async_scraper.ScrapeStats
+    """
+    results = {}
+    work = tempfile.mkdtemp()
+
+    try:
+        with MockBplServer(generate_officers(officers), latency=latency) as server:
+            for count in sessions:
+                stats = scrape_to_file(letter_combos, f"{work}/{count}.tsv", sessions=count, rate_limit=rate_limit,
+                                       url=server.url, log=False)
+                results[count] = stats
+
+                if log:
+                    print(f"{count:>3} sessions: {stats}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return results
+
+
+def compare_result_parsers(directory=None, repeat=20, log=True):
+    """
+    Time reading pages of search results line by line, with trim_left and the
+    pull_* functions, against results_parser reading them in one pass. The two are
+    checked to agree on every page first
+
+    :param directory: Saved .html pages of results to read, otherwise some are made up
+    with mock_bpl
+    :param repeat: How many times to read each page
+    :return: A dict of method: microseconds per page
+    """
+    if directory:
+        pages = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".html"):
+                with open(f"{directory}/{filename}", "rb") as f:
+                    pages.append(f.read())
+    else:
+        officers = generate_officers(5000)
+        pages = []
+        for term in ("ab", "mc", "sa", "wo", "zz"):
+            rows = [officer for officer in officers if officer[0].lower().startswith(term)]
+            for page in (1, 2, 12):
+                pages.append(render_page(term, page, rows).encode("utf-8"))
+
+    texts = [page.decode("utf-8") for page in pages]
+
+    for text in texts:
+        results = parse_results_page(text)
+        line_by_line = [[browser_text(field) for field in entry] for entry in pull_entries_from_page(text)]
+        if results.rows != line_by_line or results.current_page != pull_current_page(text):
+            raise ValueError("The parsers disagree about a page")
+
+    def line_by_line(text):
+        # What each page visit used to cost, the pager read once and the rows once
+        pull_current_page(text)
+        pull_entries_from_page(text)
+
+    methods = {
+        "line by line": line_by_line,
+        "one pass": parse_results_page,
+    }
+
+    results = {}
+    for method, parse in methods.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                parse(text)
+        results[method] = (time.perf_counter() - start) / (repeat * len(texts)) * 1e6
+
+        if log:
+            print(f"{method:>16}: {results[method]:7.1f} us per page")
+
+    return results
+
+
+def compare_scrapers(officers=5000, corpus=None, latency=0.01, workers=4, backends=BACKENDS, log=True):
+    """
+    Scrape everything from a mock_bpl.MockBplServer with each backend in turn, and
+    check they all saved the same file. Selenium is left out if it isn't installed
+
+    :param officers: How many made up officers the mock serves
+    :param corpus: A directory recorded by fixtures.record_corpus to serve instead
+    :param latency: Seconds the mock waits before each response
+    :param workers: Passed to scrape_all_data
+    :return: A dict of backend: (seconds, requests, entries a second)
+    """
+    results = {}
+    files = {}
+    work = tempfile.mkdtemp()
+
+    try:
+        served = None if corpus else generate_officers(officers)
+        with MockBplServer(served, latency=latency, corpus=corpus) as server:
+            for backend in backends:
+                if backend == "selenium" and bpl_scraper.webdriver is None:
+                    if log:
+                        print(f"{backend:>8}: skipped, Selenium isn't installed")
+                    continue
+
+                requests = server.requests
+                start = time.perf_counter()
+
+                # scrape_all_data prints every entry, which would swamp the timings
+                with contextlib.redirect_stdout(io.StringIO()):
+                    scrape_all_data("benchmark", f"{work}/{backend}", workers=workers, url=server.url, backend=backend)
+
+                seconds = time.perf_counter() - start
+
+                with open(f"{work}/{backend}/benchmark.tsv", "r") as f:
+                    files[backend] = f.read()
+                entries = files[backend].count("\n")
+
+                results[backend] = (seconds, server.requests - requests, entries / seconds)
+
+                if log:
+                    print(f"{backend:>8}: {entries} entries in {seconds:.2f}s, {results[backend][1]} requests, "
+                          f"{results[backend][1] / seconds:.1f} req/s, {entries / seconds:.0f} entries/s")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if log:
+        print(f"Identical: {len(set(files.values())) <= 1}")
+
+    return results
+
+
+if __name__ == "__main__":
+    measure_entry_memory("sample_repo/scrape/20211101.tsv")
+    compare_codecs("sample_repo")
+    async_scrape_throughput()
+    compare_result_parsers()
+    compare_scrapers()
@@ -1,15 +1,34 @@
 import os
+import queue
 import re
-
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
+import threading
+
+try:
+    from selenium import webdriver
+    from selenium.common.exceptions import NoSuchElementException
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+except ImportError:
+    # Only the selenium backend needs it, the http one does without a browser
+    webdriver = None
+
+from compressed import compressed_name, find_file, open_text
+from diffy import temporary_name
+from results_parser import parse_results_page
 
 # The namesake of the scraper
 bpl_url = "https://www.bpl-orsnapshot.net/PublicInquiry_CJ/EmployeeSearch.aspx"
 
+# Every search term, in the order their results go in the file
+letter_combos = [chr(i) + chr(j) for i in range(97, 123) for j in range(97, 123)]
+
+# How many more times a search term is tried, each with a fresh driver, before giving up on it
+SCRAPE_RETRIES = 2
+
+# Ways of getting at the search page, see backend_functions and async_scraper
+BACKENDS = ("selenium", "http", "async")
+
 
 def trim_left(html, phrase):
     # Get rid of everything before the table starts
@@ -40,14 +59,72 @@ def pull_singleton_from_line(line):
     return rank
 
 
-def go_to_previous_page(driver):
+def pull_current_page(html):
+    """
+    The line by line way of reading the pager, results_parser does it in one pass
+
+    :return: The highlighted page number in the pager, or None if there is only one page
+    """
     # Get the part of the page that has page numbers
-    trimmed_html = trim_left(driver.page_source, "ListFooter")
+    trimmed_html = trim_left(html, "ListFooter")
 
     try:
         # If there are multiple pages, this will get the highlighted one
-        current_page = int(trimmed_html[3].split("<span>")[1].split("</span>")[0])
+        return int(trimmed_html[3].split("<span>")[1].split("</span>")[0])
     except IndexError:
+        # There is only one page
+        return None
+
+
+def pull_entries_from_page(html):
+    """
+    Collect the entries on one page of search results, line by line. results_parser
+    does it in one pass
+    """
+    trimmed_html = trim_left(html, "ListTableAnyHeight")
+
+    entries = []
+
+    # Loop variables
+    marked_line = 0
+    to_add = []
+
+    for line in trimmed_html:
+
+        # Find second and third lines with entry info
+        if 1 <= marked_line <= 3:
+
+            # As it happens only the 1st and 3rd lines are taken
+            if marked_line % 2:
+                to_add.append(pull_singleton_from_line(line))
+
+            marked_line = (marked_line + 1) % 4
+
+        # Find first line with entry info
+        if "align=\"left\"" in line:
+            to_add += pull_name_and_such_from_line(line)
+            marked_line = 1
+
+        # If a new to_add has finished being constructed
+        if marked_line == 0 and to_add:
+            entries.append(to_add)
+            to_add = []
+
+    return entries
+
+
+def go_to_previous_page(driver, results=None):
+    """
+    Instruct the webdriver to find and go to the previous page if one exists.
+
+    :param results: The current page's ResultsPage, if it's already been parsed
+    return: Whether this action succeeded
+    """
+    if results is None:
+        results = parse_results_page(driver.page_source)
+
+    current_page = results.current_page
+    if current_page is None:
         # There is only one page
         return False
 
@@ -75,20 +152,18 @@ def go_to_previous_page(driver):
         return False
 
 
-def go_to_next_page(driver):
+def go_to_next_page(driver, results=None):
     """
     Instruct the webdriver to find and go to the next page if one exists.
 
+    :param results: The current page's ResultsPage, if it's already been parsed
     return: Whether this action succeeded
     """
+    if results is None:
+        results = parse_results_page(driver.page_source)
 
-    # Get the part of the page that has page numbers
-    trimmed_html = trim_left(driver.page_source, "ListFooter")
-
-    try:
-        # If there are multiple pages, this will get the highlighted one
-        current_page = int(trimmed_html[3].split("<span>")[1].split("</span>")[0])
-    except IndexError:
+    current_page = results.current_page
+    if current_page is None:
         # There is only one page
         return False
 
@@ -131,68 +206,159 @@ def scrape_from_all_pages(driver, search_term):
     search_bar.send_keys(Keys.RETURN)
 
     # Ensure we're on the first page (what a weird bug)
-    while go_to_previous_page(driver):
-        pass
+    # Each page is only parsed once, see results_parser
+    results = parse_results_page(driver.page_source)
+    while go_to_previous_page(driver, results):
+        results = parse_results_page(driver.page_source)
 
-    trimmed_html = trim_left(driver.page_source, "ListTableAnyHeight")
+    entries = list(results.rows)
 
-    entries = []
+    while go_to_next_page(driver, results):
+        results = parse_results_page(driver.page_source)
+        entries += results.rows
 
-    current_page = 1
-    while True:
+    return entries
+
+
+def open_driver(url=bpl_url):
+    """
+    Start a headless Chrome driver on the search page
+    """
+    if webdriver is None:
+        raise ValueError("Selenium isn't installed, install it or use the http backend")
 
-        # Loop variables
-        marked_line = 0
-        to_add = []
+    options = Options()
+    options.headless = True
+
+    # If your driver is in a different place, change this
+    driver = webdriver.Chrome(executable_path="chromedriver", options=options)
+    driver.get(url)
+    return driver
 
-        if current_page > 1:
-            if not go_to_next_page(driver):
-                # No more pages exist to harvest
-                break
-            else:
-                # Next page is ready to be harvested and trimmed
-                trimmed_html = trim_left(driver.page_source, "ListTableAnyHeight")
 
-        for line in trimmed_html:
+def backend_functions(backend):
+    """
+    :param backend: One of BACKENDS
+    :return: How to open a session on the search page given its url, and how to scrape
+    a search term with one. Sessions are closed with quit(), like a driver
+    """
+    if backend == "selenium":
+        return open_driver, scrape_from_all_pages
+    elif backend == "http":
+        # Imported here since http_scraper builds on this module
+        from http_scraper import open_session, scrape_from_all_pages as scrape_over_http
+        return open_session, scrape_over_http
+    elif backend == "async":
+        raise ValueError("The async backend runs its own sessions, see async_scraper.scrape_to_file")
 
-            # Find second and third lines with entry info
-            if 1 <= marked_line <= 3:
+    raise ValueError(f"Unknown backend {backend}, must be one of {', '.join(BACKENDS)}")
 
-                # As it happens only the 1st and 3rd lines are taken
-                if marked_line % 2:
-                    to_add.append(pull_singleton_from_line(line))
 
-                marked_line = (marked_line + 1) % 4
+def scrape_worker(terms, results, failures, url=bpl_url, retries=SCRAPE_RETRIES, backend="selenium"):
+    """
+    Take search terms off the queue until it's empty, scraping each with this
+    worker's own driver into results
 
-            # Find first line with entry info
-            if "align=\"left\"" in line:
-                to_add += pull_name_and_such_from_line(line)
-                marked_line = 1
+    A term which fails is tried again with a new driver, since the old one may be
+    stuck on a half-loaded page. If it still fails after retries more tries, the
+    error goes into failures and the worker carries on with the next term
+    """
+    open_session, scrape = backend_functions(backend)
+    driver = None
 
-            # If a new to_add has finished being constructed
-            if marked_line == 0 and to_add:
-                entries.append(to_add)
-                to_add = []
+    try:
+        while True:
+            try:
+                search_term = terms.get_nowait()
+            except queue.Empty:
+                return
+
+            for attempt in range(retries + 1):
+                try:
+                    if driver is None:
+                        driver = open_session(url)
+                    results[search_term] = scrape(driver, search_term)
+                    break
+                except Exception as e:
+                    failures[search_term] = e
+                    if driver is not None:
+                        try:
+                            driver.quit()
+                        except Exception:
+                            pass
+                        driver = None
+
+            if search_term in results:
+                failures.pop(search_term, None)
+    finally:
+        if driver is not None:
+            driver.quit()
+
+
+def scrape_terms(search_terms, workers=1, url=bpl_url, retries=SCRAPE_RETRIES, backend="selenium"):
+    """
+    Scrape each search term with a pool of workers, each driving its own browser.
+    Terms are handed out one at a time, so a slow term only holds up its own worker
 
-        current_page += 1
+    :param workers: How many drivers to run at once
+    :param backend: One of BACKENDS, "http" talks to the page directly instead of through a browser
+    :return: A dict of search term: entries, and a dict of search term: the error it
+    failed with, for any which couldn't be scraped
+    """
+    terms = queue.Queue()
+    for search_term in search_terms:
+        terms.put(search_term)
 
-    return entries
+    # Each worker has its own buffers, they're only put together once everyone's done
+    buffers = [({}, {}) for _ in range(max(workers, 1))]
+    threads = [
+        threading.Thread(target=scrape_worker, args=(terms, results, failures, url, retries, backend))
+        for results, failures in buffers
+    ]
 
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-def scrape_all_data(datecode=None, directory=None, overwrite=False):
+    results = {}
+    failures = {}
+    for worker_results, worker_failures in buffers:
+        results.update(worker_results)
+        failures.update(worker_failures)
+
+    return results, failures
+
+
+def scrape_all_data(datecode=None, directory=None, overwrite=False, compression=None, workers=1,
+                    retries=SCRAPE_RETRIES, url=bpl_url, backend="selenium", rate_limit=None, timeout=None):
     """
     Systematically collect and save the data from each search result, resulting
     in a complete set of the day's data
 
+    Nothing is saved unless every search term was scraped, since a missing term
+    would look like everyone under it had been removed
+
     :param datecode: To be used to generate the filename
     :param directory: To be used to generate the filename
     :param overwrite: If the generated file already exists, determine whether to overwrite it
+    :param compression: An extension from compressed.CODECS to compress the file with
+    :param workers: How many browsers to scrape with at once, see scrape_terms, or how many
+    sessions for the async backend
+    :param retries: How many more times to try a search term which fails
+    :param url: The search page, eg a mock_bpl.MockBplServer to try things out on
+    :param backend: One of BACKENDS, they all save exactly the same file
+    :param rate_limit: For the async backend, the most requests a second to make
+    :param timeout: For the async backend, how many seconds each search term gets
     """
 
     # If called without arguments, no harm done
     if not datecode:
         return
 
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, must be one of {', '.join(BACKENDS)}")
+
     if directory and not os.path.isdir(directory):
         os.mkdir(directory)
 
@@ -201,39 +367,44 @@ def scrape_all_data(datecode=None, directory=None, overwrite=False):
     else:
         filename = f"{datecode}.tsv"
 
-    # If it already exists, try to overwrite it
-    # I'll be careful, I promise
-    if os.path.exists(filename):
-        if overwrite:
-            with open(filename, "w"):
-                pass
-        else:
-            print(f"Won't overwrite existing file {filename}")
-            return
-
-    letter_combos = [chr(i) + chr(j) for i in range(97, 123) for j in range(97, 123)]
-
-    options = Options()
-    options.headless = True
-
-    # If your driver is in a different place, change this
-    driver = webdriver.Chrome(executable_path="chromedriver", options=options)
-    driver.get(bpl_url)
+    # An existing file counts whether or not it's compressed
+    existing = find_file(filename)
+    filename = compressed_name(filename, compression)
 
-    # Create TSV folder if one doesn't exist
-    if not os.path.isdir(directory):
-        os.mkdir(directory)
-
-    for search_term in letter_combos:
-        entries = scrape_from_all_pages(driver, search_term)
+    # If it already exists, it's only overwritten once the new one is ready
+    # I'll be careful, I promise
+    if os.path.exists(existing) and not overwrite:
+        print(f"Won't overwrite existing file {existing}")
+        return
 
-        # Only bother if there are actually entries
-        if entries:
-            with open(filename, "a+") as f:
-                for entry in entries:
-                    print(entry)
-                    f.write("\t".join(entry) + "\n")
-        else:
-            print(f"No entries for {search_term}")
+    if backend == "async":
+        # Imported here since async_scraper builds on this module
+        from async_scraper import TERM_TIMEOUT, scrape_to_file
 
-    driver.close()
+        scrape_to_file(letter_combos, temporary_name(filename), sessions=workers, rate_limit=rate_limit,
+                       timeout=timeout or TERM_TIMEOUT, retries=retries, url=url)
+    else:
+        results, failures = scrape_terms(letter_combos, workers=workers, url=url, retries=retries, backend=backend)
+
+        if failures:
+            for search_term, error in failures.items():
+                print(f"Failed to scrape {search_term}: {error!r}")
+            raise ValueError(f"Could not scrape {len(failures)} search terms, not saving {filename}")
+
+        # Results go in the same order whichever worker got them, so the file is the same
+        # however many workers there were
+        with open_text(temporary_name(filename), "w") as f:
+            for search_term in letter_combos:
+                entries = results[search_term]
+
+                # Only bother if there are actually entries
+                if entries:
+                    for entry in entries:
+                        print(entry)
+                        f.write("\t".join(entry) + "\n")
+                else:
+                    print(f"No entries for {search_term}")
+
+    if existing != filename and os.path.exists(existing):
+        os.remove(existing)
+    os.replace(temporary_name(filename), filename)
@@ -0,0 +1,160 @@
+import gzip
+import io
+import lzma
+import os
+import zlib
+
+"""
+Reading and writing archive files which may be compressed, so the rest of the
+archive doesn't need to care.
+
+A compressed file is named like the plain one with the codec's extension on the
+end, eg 20211101.tsv.gz. Everything still asks for 20211101.tsv, and find_file
+picks up whichever version is on disk.
+"""
+
+# Extension: codec, using only what ships with Python
+CODECS = {
+    "gz": "gzip",
+    "xz": "lzma",
+    "zz": "zlib",
+}
+
+# Leading bytes which give a codec away. zlib's two byte header can look like
+# text, so zlib files are only recognised by their extension
+MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\xfd7zXZ\x00": "lzma",
+}
+
+# How many compressed bytes ZlibFile reads at a time
+ZLIB_BLOCK_SIZE = 1 << 16
+
+
+def compressed_name(filepath, compression=None):
+    """
+    :param compression: An extension from CODECS, or None to leave the file uncompressed
+    :return: The name filepath should be written under
+    """
+    if not compression:
+        return filepath
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression {compression}, must be one of {', '.join(CODECS)}")
+    return f"{filepath}.{compression}"
+
+
+def find_file(filepath):
+    """
+    :return: filepath if it exists, otherwise the first compressed version of it
+    which does, otherwise filepath anyway so the error makes sense
+    """
+    if os.path.exists(filepath):
+        return filepath
+    for extension in CODECS:
+        if os.path.exists(f"{filepath}.{extension}"):
+            return f"{filepath}.{extension}"
+    return filepath
+
+
+def file_exists(filepath):
+    """
+    Whether filepath or a compressed version of it exists
+    """
+    return os.path.exists(find_file(filepath))
+
+
+def detect_codec(filepath):
+    """
+    :return: The codec filepath is compressed with, or None if it isn't
+    """
+    extension = filepath.rsplit(".", 1)[-1]
+    if extension in CODECS:
+        return CODECS[extension]
+
+    if os.path.exists(filepath):
+        with open(filepath, "rb") as f:
+            header = f.read(6)
+        for magic, codec in MAGIC.items():
+            if header.startswith(magic):
+                return codec
+
+    return None
+
+
+def open_text(filepath, mode="r", buffering=-1):
+    """
+    Open filepath for reading or writing text, streaming it through whichever codec
+    it uses. Reading goes by the extension or the file's header, writing and
+    appending by the extension
+    """
+    codec = detect_codec(filepath) if "r" in mode else CODECS.get(filepath.rsplit(".", 1)[-1])
+
+    if codec is None:
+        return open(filepath, mode, buffering=buffering)
+
+    # Compressed files can't be read and written at once
+    mode = mode.replace("+", "")
+
+    if codec == "gzip":
+        return gzip.open(filepath, mode + "t", encoding="utf-8")
+    elif codec == "lzma":
+        return lzma.open(filepath, mode + "t", encoding="utf-8")
+    else:
+        raw = ZlibFile(filepath, mode)
+        buffered = io.BufferedReader(raw) if mode == "r" else io.BufferedWriter(raw)
+        return io.TextIOWrapper(buffered, encoding="utf-8")
+
+
+class ZlibFile(io.RawIOBase):
+    """
+    A zlib stream as a file, since unlike gzip and lzma the zlib module doesn't
+    come with one
+
+    Appending starts a new stream on the end, and reading carries on through each
+    of them in turn, the same as gzip does with its members
+    """
+
+    def __init__(self, filepath, mode="r"):
+        super().__init__()
+        self._mode = mode
+        self._file = open(filepath, mode + "b")
+
+        if mode == "r":
+            self._decompressor = zlib.decompressobj()
+            self._buffer = b""
+        else:
+            self._compressor = zlib.compressobj()
+
+    def readable(self):
+        return self._mode == "r"
+
+    def writable(self):
+        return self._mode != "r"
+
+    def readinto(self, b):
+        while not self._buffer:
+            data = self._decompressor.unused_data or self._file.read(ZLIB_BLOCK_SIZE)
+            if not data:
+                return 0
+
+            if self._decompressor.eof:
+                # On to the next stream
+                self._decompressor = zlib.decompressobj()
+
+            self._buffer = self._decompressor.decompress(data)
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def write(self, b):
+        self._file.write(self._compressor.compress(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self.writable():
+                self._file.write(self._compressor.flush())
+            self._file.close()
+        super().close()
@@ -1,10 +1,54 @@
+import bisect
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from compressed import compressed_name, find_file, open_text
+
+# How many days apart DiffEntryHistory keyframes are written by the pipeline
+KEYFRAME_INTERVAL = 30
+
+# How many parsed DiffEntryLists an opened DiffEntryHistory keeps in memory at once
+DIFF_CACHE_SIZE = 64
+
+# How many entries' worth of rebuilt snapshots a DiffEntryHistory keeps in memory,
+# at roughly 200 bytes per entry this is about 50MB
+SNAPSHOT_CACHE_BUDGET = 250000
+
+# How many entries the streaming readers hand back at a time
+READ_CHUNK_SIZE = 4096
+
+# Buffer size in bytes for the streaming writers
+WRITE_BUFFER_SIZE = 1 << 20
+
+# What rebase names the cold segments it moves old files into
+COLD_PREFIX = "_cold_"
+
+# Fields EntryList.where and friends can filter on, and the low-cardinality ones
+# among them which get a secondary index
+QUERY_FIELDS = ("name", "dpsst_num", "agency", "rank", "status")
+INDEXED_FIELDS = ("agency", "rank", "status")
+
+
 class Entry:
     """
     An individual data point from the BPL site
+
+    Entries use __slots__ rather than a per-instance __dict__, and the agency, rank
+    and status columns are interned. Those only take a few hundred distinct values
+    across ~35k rows, so every Entry sharing a value points at the same string
     """
 
+    __slots__ = ("name", "dpsst_num", "agency", "rank", "status")
+
     def __init__(self, data):
-        if isinstance(data, DiffEntry):
+        if isinstance(data, Entry):
+            # Already interned
             self.name = data.name
             self.dpsst_num = data.dpsst_num
             self.agency = data.agency
@@ -17,16 +61,16 @@ class Entry:
             self.dpsst_num = data[1]
 
             if len(data) > 2:
-                self.agency = data[2]
+                self.agency = sys.intern(data[2])
             else:
                 self.agency = ""
 
             if len(data) > 3:
                 # For backwards compatibility's sake
-                self.rank = data[3]
+                self.rank = sys.intern(data[3])
 
                 # Not currently used in comparisons but recorded anyway
-                self.status = data[4]
+                self.status = sys.intern(data[4])
             else:
                 self.rank = ""
                 self.status = ""
@@ -35,13 +79,29 @@ class Entry:
         if not isinstance(other, Entry):
             return False
         else:
-            return self.name == other.name \
-                   and self.dpsst_num == other.dpsst_num \
-                   and self.agency == other.agency \
-                   and self.rank == other.rank
+            return self.key() == other.key()
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.key())
+
+    @classmethod
+    def from_fields(cls, name, dpsst_num, agency="", rank="", status=""):
+        """
+        Build an Entry straight from its fields rather than from a TSV line
+        """
+        entry = cls.__new__(cls)
+        entry.name = name
+        entry.dpsst_num = dpsst_num
+        entry.agency = sys.intern(agency)
+        entry.rank = sys.intern(rank)
+        entry.status = sys.intern(status)
+        return entry
+
+    def key(self):
+        """
+        The fields used when comparing Entries. Status is deliberately left out
+        """
+        return self.name, self.dpsst_num, self.agency, self.rank
 
     def __str__(self):
         return "\t".join([self.name, self.dpsst_num, self.agency, self.rank, self.status])
@@ -50,14 +110,30 @@ class Entry:
 class EntryList:
 
     def __init__(self, data=None):
-        self.data = []
+        self._data = []
+
+        # Multiset bookkeeping used by process_diff, built on first use
+        self._counts = None
+        self._pending = Counter()
+
+        # Entries grouped by DPSST number, built on first lookup
+        self._by_dpsst = None
+
+        # Field: {value: positions in data}, each built the first time it's queried
+        self._columns = {}
+
         if data:
             for each in data:
                 if isinstance(each, Entry):
-                    self.data.append(each)
+                    self._data.append(each)
                 else:
                     raise ValueError("Can only add Entries to EntryList")
 
+    @property
+    def data(self):
+        self._compact()
+        return self._data
+
     def __iter__(self):
         return iter(self.data)
 
@@ -71,27 +147,71 @@ class EntryList:
         return len(self.data)
 
     def __str__(self):
-        output = ""
-        for entry in self:
-            output += str(entry) + "\n"
-        return output
+        return "".join(f"{entry}\n" for entry in self)
 
     @staticmethod
     def open(filepath):
         entries = []
-        with open(filepath, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                entries.append(Entry(line[:-1]))
+        for chunk in read_entries(filepath):
+            entries.extend(chunk)
         return EntryList(entries)
 
     def append(self, item):
         if isinstance(item, Entry):
-            self.data.append(item)
+            self._data.append(item)
+            if self._counts is not None:
+                self._counts[item.key()] += 1
+            if self._by_dpsst is not None:
+                self._by_dpsst.setdefault(item.dpsst_num, []).append(item)
+            for field, column in self._columns.items():
+                column.setdefault(getattr(item, field), []).append(len(self._data) - 1)
         else:
             raise ValueError("Can only add Entries to EntryList")
 
-    def diff(self, other, log=True):
+    def remove(self, item):
+        """
+        Remove the earliest Entry equal to item, if there is one
+
+        Removals are only recorded here and applied in a single pass the next time
+        the contents are read, so a run of removals costs O(1) each
+
+        :return: Whether a matching Entry was found
+        """
+        if not isinstance(item, Entry):
+            raise ValueError("Can only remove Entries from EntryList")
+
+        if self._counts is None:
+            self._counts = Counter(entry.key() for entry in self.data)
+
+        key = item.key()
+        if self._counts[key] > 0:
+            self._counts[key] -= 1
+            self._pending[key] += 1
+            self._by_dpsst = None
+            self._columns = {}
+            return True
+        return False
+
+    def _compact(self):
+        # Drop pending removals. Removal always takes the earliest remaining match
+        # and new Entries only ever go on the end, so the removed Entries are
+        # exactly the first few occurrences of each key
+        if not self._pending:
+            return
+
+        pending = self._pending
+        kept = []
+        for entry in self._data:
+            key = entry.key()
+            if pending[key] > 0:
+                pending[key] -= 1
+            else:
+                kept.append(entry)
+
+        self._data = kept
+        self._pending = Counter()
+
+    def diff(self, other, log=True, workers=None):
         """
         If self is A and other is B, then:
         A ~ B =
@@ -100,31 +220,119 @@ class EntryList:
 
         In order for differencing to work properly, A must be from the earlier today,
         and B from the later today otherwise the results will be reversed
+
+        Duplicates are matched up one for one, earliest first. Neither A nor B is modified
+
+        :param workers: If more than 1, split the work by DPSST number across this many
+        processes. The results are the same either way
         """
         if not isinstance(other, EntryList):
             raise ValueError(f"Cannot difference {type(other)}, only EntryList")
         else:
-            new = []
             if log:
                 print("Differencing EntryLists...")
-            for entry in other:
-                if entry in self:
-                    self.data.pop(self.data.index(entry))
-                else:
-                    new.append(entry)
+
+            old = self.data
+            new = other.data
+
+            if workers and workers > 1:
+                removed, added = diff_sharded(old, new, workers)
+            else:
+                removed, added = diff_keys(
+                    [(n, entry.key()) for n, entry in enumerate(old)],
+                    [(n, entry.key()) for n, entry in enumerate(new)]
+                )
+
             if log:
                 print("Differencing complete.")
-            return [self, EntryList(new)]
+            return [EntryList([old[n] for n in removed]), EntryList([new[n] for n in added])]
 
     def get_by_dpsst_num(self, dpsst_num):
         """
         Get the contents of the EntryList where DPSST number matches
         """
-        output = EntryList()
-        for entry in self:
-            if entry.dpsst_num == dpsst_num:
-                output.append(entry)
-        return output
+        if self._by_dpsst is None:
+            self._by_dpsst = {}
+            for entry in self:
+                self._by_dpsst.setdefault(entry.dpsst_num, []).append(entry)
+
+        return EntryList(self._by_dpsst.get(dpsst_num, []))
+
+    def _column(self, field):
+        if field not in self._columns:
+            column = {}
+            for n, entry in enumerate(self.data):
+                column.setdefault(getattr(entry, field), []).append(n)
+            self._columns[field] = column
+        return self._columns[field]
+
+    def _select(self, filters):
+        # Positions in data of the entries which pass every filter
+        tests = [parse_filter(lookup, value) for lookup, value in filters.items()]
+        data = self.data
+
+        # Indexed fields are tested once per distinct value rather than once per entry
+        indexed = []
+        rest = []
+        for field, test in tests:
+            if field in INDEXED_FIELDS:
+                column = self._column(field)
+                values = {value for value in column if test(value)}
+                indexed.append((sum(len(column[value]) for value in values), field, values))
+            else:
+                rest.append((field, test))
+
+        if indexed:
+            # Start from whichever index narrows things down the most
+            indexed.sort(key=lambda item: item[0])
+            size, field, values = indexed[0]
+            column = self._column(field)
+            positions = sorted(n for value in values for n in column[value])
+            rest = [(field, values.__contains__) for size, field, values in indexed[1:]] + rest
+        else:
+            positions = range(len(data))
+
+        return [n for n in positions if all(test(getattr(data[n], field)) for field, test in rest)]
+
+    def where(self, **filters):
+        """
+        Get the entries matching every filter, in their original order. Filters are
+        given as field=value for equality, or field__op=value where op is one of:
+
+            ieq: equal, ignoring case
+            contains: value is a substring
+            icontains: value is a substring, ignoring case
+
+        Value can also be a tuple of values, any of which can match. For example,
+        where(status="Active", agency__icontains=("multnomah", "clackamas"))
+
+        Agency, rank and status are indexed the first time they're queried
+        """
+        data = self.data
+        return EntryList([data[n] for n in self._select(filters)])
+
+    def count(self, **filters):
+        """
+        Count the entries matching every filter, see where
+        """
+        if not filters:
+            return len(self)
+        return len(self._select(filters))
+
+    def group_by(self, field, **filters):
+        """
+        Count the entries matching every filter by the value of field, see where
+
+        :return: A Counter of value: number of entries
+        """
+        if field not in QUERY_FIELDS:
+            raise ValueError(f"Cannot group by {field}")
+
+        if field in INDEXED_FIELDS and not filters:
+            return Counter({value: len(positions) for value, positions in self._column(field).items()})
+
+        data = self.data
+        return Counter(getattr(data[n], field) for n in self._select(filters))
 
     def sum(self, other):
         """
@@ -144,20 +352,22 @@ class EntryList:
         if not isinstance(diff, DiffEntryList):
             raise ValueError(f"Cannot process {type(diff)}, only DiffEntryList")
         else:
-            to_add = []
+            # Additions go first so a removal can cancel an addition from the same day
             to_remove = []
             for diff_entry in diff:
-                entry = Entry(str(diff_entry)[1:])
+                entry = Entry(diff_entry)
                 if diff_entry.mode == "+":
-                    to_add.append(entry)
+                    self.append(entry)
                 else:
                     to_remove.append(entry)
-            self.sum(EntryList(to_add))
-            self.diff(EntryList(to_remove), log=False)
+            for entry in to_remove:
+                self.remove(entry)
 
 
 class DiffEntry(Entry):
 
+    __slots__ = ("mode",)
+
     def __init__(self, data):
         super().__init__(data[1:])
         self.mode = data[0]
@@ -166,6 +376,61 @@ class DiffEntry(Entry):
         return self.mode + super().__str__()
 
 
+class ModifiedEntry(DiffEntry):
+    """
+    A removal and an addition with the same DPSST number, stored as one line with
+    the old entry followed by just the fields which changed, eg
+
+        ~name\tdpsst_num\tagency\trank\tstatus\trank=Sergeant\tstatus=Active
+
+    Compares as the old entry. DiffEntryList reads it back as the "-" and "+"
+    DiffEntries it stands for
+    """
+
+    __slots__ = ("changes",)
+
+    # Fields which can change, dpsst_num is what ties the two halves together
+    fields = ("name", "agency", "rank", "status")
+
+    def __init__(self, data):
+        fields = data[1:].split("\t")
+        Entry.__init__(self, "\t".join(fields[:5]))
+        self.mode = "~"
+        self.changes = tuple(tuple(change.split("=", 1)) for change in fields[5:])
+
+    @classmethod
+    def from_pair(cls, old, new):
+        """
+        Build a ModifiedEntry from the old and new Entries for the same DPSST number
+        """
+        if old.dpsst_num != new.dpsst_num:
+            raise ValueError(f"Cannot pair DPSST numbers {old.dpsst_num} and {new.dpsst_num}")
+
+        entry = cls.from_fields(old.name, old.dpsst_num, old.agency, old.rank, old.status)
+        entry.mode = "~"
+        entry.changes = tuple(
+            (field, getattr(new, field)) for field in cls.fields if getattr(old, field) != getattr(new, field)
+        )
+        return entry
+
+    def split(self):
+        """
+        :return: The "-" and "+" DiffEntries this stands for
+        """
+        old = DiffEntry.from_fields(self.name, self.dpsst_num, self.agency, self.rank, self.status)
+        old.mode = "-"
+
+        new = DiffEntry.from_fields(self.name, self.dpsst_num, self.agency, self.rank, self.status)
+        new.mode = "+"
+        for field, value in self.changes:
+            setattr(new, field, sys.intern(value))
+
+        return old, new
+
+    def __str__(self):
+        return super().__str__() + "".join(f"\t{field}={value}" for field, value in self.changes)
+
+
 class DiffEntryList:
 
     def __init__(self, diff_entries=None):
@@ -178,19 +443,55 @@ class DiffEntryList:
                     self.diff_entries.append(entry)
 
     def __iter__(self):
-        return iter(self.diff_entries)
+        # Modified records are read as the removal and addition they stand for, so
+        # only diff_entries has them as they're stored
+        for diff_entry in self.diff_entries:
+            if diff_entry.mode == "~":
+                yield from diff_entry.split()
+            else:
+                yield diff_entry
 
     @staticmethod
     def open(filename):
-        with open(filename, "r") as f:
-            data = f.readlines()
-
         output = DiffEntryList()
-        for line in data:
-            output.append(DiffEntry(line.strip()))
+        for chunk in read_diff_entries(filename):
+            for diff_entry in chunk:
+                output.append(diff_entry)
 
         return output
 
+    @staticmethod
+    def from_diff(removed, added, modified=True):
+        """
+        Build the DiffEntryList for the output of EntryList.diff
+
+        :param modified: Pair up removals and additions with the same DPSST number
+        as ModifiedEntries. Each takes the place of its addition, so replaying them
+        gives exactly the same result as the separate "-" and "+" lines would
+        """
+        if not modified:
+            return DiffEntryList(
+                [DiffEntry("-" + str(entry)) for entry in removed] + [DiffEntry("+" + str(entry)) for entry in added]
+            )
+
+        unpaired = {}
+        for entry in removed:
+            unpaired.setdefault(entry.dpsst_num, []).append(entry)
+
+        additions = []
+        for entry in added:
+            if unpaired.get(entry.dpsst_num):
+                additions.append(ModifiedEntry.from_pair(unpaired[entry.dpsst_num].pop(0), entry))
+            else:
+                additions.append(DiffEntry("+" + str(entry)))
+
+        # Leftover removals keep their original order
+        remaining = {id(entry) for entries in unpaired.values() for entry in entries}
+
+        return DiffEntryList(
+            [DiffEntry("-" + str(entry)) for entry in removed if id(entry) in remaining] + additions
+        )
+
     def append(self, item):
         if not isinstance(item, DiffEntry):
             raise ValueError(f"Incompatible type {type(item)}, must be DiffEntry")
@@ -211,24 +512,348 @@ class DiffEntryList:
                 output.append(entry)
         return output
 
+    def modified(self):
+        """
+        :return: A DiffEntryList of just the ModifiedEntries
+        """
+        output = DiffEntryList()
+        for entry in self.diff_entries:
+            if entry.mode == "~":
+                output.append(entry)
+        return output
+
+
+def parse_filter(lookup, value):
+    """
+    Turn a filter like agency__icontains="portland" into the field it applies to and
+    a test for values of that field, see EntryList.where
+    """
+    field, _, op = lookup.partition("__")
+    if field not in QUERY_FIELDS:
+        raise ValueError(f"Cannot filter on {field}")
+
+    values = (value,) if isinstance(value, str) else tuple(value)
+
+    if op in ("", "eq"):
+        values = set(values)
+        return field, values.__contains__
+    elif op == "ieq":
+        values = {each.lower() for each in values}
+        return field, lambda x: x.lower() in values
+    elif op == "contains":
+        return field, lambda x: any(each in x for each in values)
+    elif op == "icontains":
+        values = [each.lower() for each in values]
+        return field, lambda x: any(each in x.lower() for each in values)
+    else:
+        raise ValueError(f"Unknown filter {lookup}")
+
+
+def diff_keys(old, new):
+    """
+    The differencing engine behind EntryList.diff
+
+    :param old: (position, key) pairs from the earlier EntryList
+    :param new: (position, key) pairs from the later EntryList
+    :return: The positions of the removed old entries and of the added new ones
+    """
+    available = Counter(key for n, key in old)
+    matched = Counter()
+    added = []
+
+    for n, key in new:
+        if available[key] > 0:
+            available[key] -= 1
+            matched[key] += 1
+        else:
+            added.append(n)
+
+    removed = []
+    for n, key in old:
+        if matched[key] > 0:
+            matched[key] -= 1
+        else:
+            removed.append(n)
+
+    return removed, added
+
+
+def diff_sharded(old, new, workers):
+    """
+    Run diff_keys in parallel. Entries are split into one shard per worker by a hash of
+    their DPSST number, so equal entries always land in the same shard, and the
+    positions coming back are merged into the order a single diff_keys would give
+
+    :return: The positions of the removed old entries and of the added new ones
+    """
+    old_shards = [[] for _ in range(workers)]
+    new_shards = [[] for _ in range(workers)]
+
+    # crc32 rather than hash() since that differs between processes
+    for entries, shards in ((old, old_shards), (new, new_shards)):
+        for n, entry in enumerate(entries):
+            shard = zlib.crc32(entry.dpsst_num.encode("utf-8")) % workers
+            shards[shard].append((n, entry.key()))
+
+    removed = []
+    added = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard_removed, shard_added in executor.map(diff_keys, old_shards, new_shards):
+            removed += shard_removed
+            added += shard_added
+
+    return sorted(removed), sorted(added)
+
+
+def read_entries(filepath, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read a snapshot TSV a line at a time, yielding lists of up to chunk_size Entries
+    so the whole file is never held in memory as text
+
+    filepath can also be compressed, see compressed.py
+    """
+    chunk = []
+    with open_text(find_file(filepath), "r") as f:
+        for line in f:
+            chunk.append(Entry(line.rstrip("\n")))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_diff_entries(filepath, chunk_size=READ_CHUNK_SIZE):
+    """
+    Like read_entries, but for the +/-/~ lines of a difference file
+    """
+    chunk = []
+    with open_text(find_file(filepath), "r") as f:
+        for line in f:
+            if line.startswith("~"):
+                # Only the newline comes off, the last change might end in whitespace
+                chunk.append(ModifiedEntry(line.rstrip("\n")))
+            else:
+                chunk.append(DiffEntry(line.strip()))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def temporary_name(filepath):
+    """
+    Where to write filepath before renaming it into place. The extension is kept so
+    the file is compressed the same way
+    """
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, f"_tmp_{filename}")
+
+
+def write_lines(filepath, lines):
+    """
+    Replace a small text file such as _meta.txt in one step, so it's never left
+    half written
+    """
+    with open(temporary_name(filepath), "w+") as f:
+        f.write("".join(f"{line}\n" for line in lines))
+    os.replace(temporary_name(filepath), filepath)
+
+
+def write_entries(filepath, entries, checksum=None):
+    """
+    Write Entries or DiffEntries to filepath one line at a time through a buffer,
+    rather than building the whole file as a string first. It's compressed if
+    filepath ends in one of the extensions in compressed.CODECS
+
+    :param checksum: A hashlib object to update with each line as it's written
+    """
+    with open_text(filepath, "w+", buffering=WRITE_BUFFER_SIZE) as f:
+        for entry in entries:
+            line = f"{entry}\n"
+            f.write(line)
+            if checksum is not None:
+                checksum.update(line.encode("utf-8"))
+
+
+class LazyDiffEntryLists:
+    """
+    A read-only sequence of DiffEntryLists which are only parsed the first time they're
+    touched. At most cache_size of them are held at once, least recently used go first
+
+    Slices share their parent's cache. The web app reads it from several threads at
+    once, so the cache is only ever touched while holding its lock
+    """
+
+    def __init__(self, sources, load=None, cache_size=DIFF_CACHE_SIZE, cache=None, lock=None):
+        self.sources = list(sources)
+        self.load = load if load else DiffEntryList.open
+        self.cache_size = cache_size
+        self._cache = cache if cache is not None else OrderedDict()
+        self._lock = lock if lock is not None else threading.Lock()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyDiffEntryLists(self.sources[i], self.load, self.cache_size, self._cache, self._lock)
+
+        source = self.sources[i]
+
+        with self._lock:
+            if source in self._cache:
+                self._cache.move_to_end(source)
+                return self._cache[source]
+
+        # Parsed outside the lock so other threads aren't held up, if two threads load
+        # the same one at once the second simply replaces the first
+        diff_el = self.load(source)
+
+        with self._lock:
+            self._cache[source] = diff_el
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return diff_el
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __len__(self):
+        return len(self.sources)
+
+
+class SnapshotCache:
+    """
+    Rebuilt EntryLists keyed by datecode, holding at most budget entries between them.
+    Least recently used go first
+
+    Datecodes rather than indices are used so that slices of a history can share it.
+    Like LazyDiffEntryLists it can be used from several threads at once
+    """
+
+    def __init__(self, budget=SNAPSHOT_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __contains__(self, datecode):
+        return datecode in self._snapshots
+
+    def get(self, datecode):
+        """
+        :return: A copy of the cached EntryList, or None
+        """
+        with self._lock:
+            if datecode in self._snapshots:
+                self.hits += 1
+                self._snapshots.move_to_end(datecode)
+                return EntryList(self._snapshots[datecode].data)
+
+            self.misses += 1
+            return None
+
+    def peek(self, datecode):
+        """
+        Like get, but doesn't count towards the hit and miss counters
+        """
+        with self._lock:
+            if datecode in self._snapshots:
+                self._snapshots.move_to_end(datecode)
+                return EntryList(self._snapshots[datecode].data)
+            return None
+
+    def put(self, datecode, entry_list):
+        if len(entry_list) > self.budget:
+            return
+
+        with self._lock:
+            if datecode in self._snapshots:
+                self.size -= len(self._snapshots.pop(datecode))
+
+            self._snapshots[datecode] = EntryList(entry_list.data)
+            self.size += len(entry_list)
+
+            while self.size > self.budget:
+                oldest_datecode, oldest = self._snapshots.popitem(last=False)
+                self.size -= len(oldest)
+
+    def datecodes(self):
+        with self._lock:
+            return list(self._snapshots)
+
 
 class DiffEntryHistory:
 
-    def __init__(self, root, meta=None, data=None, directory=None):
-        self.root = root
+    def __init__(self, root, meta=None, data=None, directory=None, keyframes=None, archive=None, cache=None):
+        # A root of None is loaded from the directory the first time it's needed
+        self._root = root
         self.data = []
         self.meta = []
         self.directory = directory
-        for item in data:
-            if not isinstance(item, DiffEntryList):
-                raise ValueError(f"Can only add DiffEntryList to DiffEntryHistory")
-            else:
-                self.data.append(item)
+        self.keyframes = []
+
+        # The PackedArchive or SqliteArchive backing this history, if it isn't stored
+        # as loose files
+        self.archive = archive
+
+        # See dpsst_index and presence_index
+        self._dpsst_index = None
+        self._presence_index = None
+
+        # The last (datecode, EntryList) queried with where and friends, so its
+        # indexes can be reused
+        self._queried = None
+
+        # Rebuilt snapshots, shared with slices of this history
+        self.cache = cache if cache is not None else SnapshotCache()
+        if isinstance(data, LazyDiffEntryLists):
+            self.data = data
+        else:
+            for item in data:
+                if not isinstance(item, DiffEntryList):
+                    raise ValueError(f"Can only add DiffEntryList to DiffEntryHistory")
+                else:
+                    self.data.append(item)
         for item in meta:
             if not isinstance(item, str):
                 raise ValueError(f"Meta can only contain strings, not {type(item)}")
             else:
                 self.meta.append(item)
+        if keyframes:
+            for item in keyframes:
+                if not isinstance(item, str):
+                    raise ValueError(f"Keyframes can only contain strings, not {type(item)}")
+                else:
+                    self.keyframes.append(item)
+
+        # Sorted meta indices which have a keyframe on disk. Index 0 is the root and
+        # keyframes from before a rebase or outside a slice simply don't match
+        self._positions = {datecode: n for n, datecode in enumerate(self.meta)}
+        self._keyframe_indices = sorted(
+            self._positions[datecode] for datecode in set(self.keyframes)
+            if self._positions.get(datecode, 0) > 0
+        )
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = self.load_snapshot(self.meta[0])
+        return self._root
+
+    def load_snapshot(self, datecode):
+        """
+        Load the root or a keyframe from wherever this history is stored
+        """
+        if self.archive is not None:
+            return self.archive.read_snapshot(datecode)
+        return EntryList.open(f"{self.directory}/{datecode}.tsv")
 
     def __getitem__(self, i):
         if isinstance(i, int):
@@ -244,7 +869,7 @@ class DiffEntryHistory:
             data = self.data[start:stop]
             meta = self.meta[start:stop]
 
-            return DiffEntryHistory(root, meta, data, self.directory)
+            return type(self)(root, meta, data, self.directory, self.keyframes, self.archive, self.cache)
 
     def __iter__(self):
         return iter(self.data)
@@ -253,27 +878,153 @@ class DiffEntryHistory:
         return len(self.data)
 
     @staticmethod
-    def open(directory):
+    def open(directory, cache_size=DIFF_CACHE_SIZE, snapshot_budget=SNAPSHOT_CACHE_BUDGET):
+        """
+        Open the archive in directory. Only the meta and keyframe lists are read here,
+        the root and each DiffEntryList are parsed on first use
+
+        If the directory holds a SQLite or packed archive, that is used instead of the
+        loose files
+
+        :param cache_size: How many parsed DiffEntryLists to keep in memory
+        :param snapshot_budget: How many entries' worth of rebuilt snapshots to keep in memory
+        """
+        # Imported here since packfile and sqlarchive build on this module
+        from packfile import PackedArchive
+        from sqlarchive import SqliteArchive
+
+        for archive_type in (SqliteArchive, PackedArchive):
+            if archive_type.exists(directory):
+                history = archive_type.open(directory).history(cache_size=cache_size)
+                history.cache.budget = snapshot_budget
+                return history
+
         with open(f"{directory}/_meta.txt") as f:
             meta = f.readlines()
 
         for n in range(len(meta)):
             meta[n] = meta[n].strip()
 
-        root = EntryList.open(f"{directory}/{meta[0]}.tsv")
+        filenames = [f"{directory}/{meta[n - 1]}-{meta[n]}.tsv" for n in range(1, len(meta))]
+        data = LazyDiffEntryLists(filenames, cache_size=cache_size)
+
+        keyframes = []
+        if os.path.exists(f"{directory}/_keyframes.txt"):
+            with open(f"{directory}/_keyframes.txt") as f:
+                keyframes = [line.strip() for line in f if line.strip()]
+
+        return DiffEntryHistory(
+            root=None, meta=meta, data=data, directory=directory, keyframes=keyframes,
+            cache=SnapshotCache(snapshot_budget)
+        )
+
+    @staticmethod
+    def save_keyframe(directory, datecode, entry_list, compression=None):
+        """
+        Write a fully materialized EntryList for datecode next to the meta file so that
+        rebuilds past that point don't have to replay from the root
+
+        Keyframes use the same format and naming as a root, {datecode}.tsv
+
+        :param compression: An extension from compressed.CODECS to compress it with
+        """
+        write_entries(compressed_name(f"{directory}/{datecode}.tsv", compression), entry_list)
+
+        keyframes = []
+        if os.path.exists(f"{directory}/_keyframes.txt"):
+            with open(f"{directory}/_keyframes.txt") as f:
+                keyframes = [line.strip() for line in f]
+
+        if datecode not in keyframes:
+            with open(f"{directory}/_keyframes.txt", "a+") as f:
+                f.write(datecode + "\n")
+
+    @staticmethod
+    def head_checksum(datecode):
+        """
+        Start the checksum tying the contents of a head snapshot to the datecode it was
+        built for. Each line of the head is fed to it in turn
+        """
+        return hashlib.sha256(f"{datecode}\n".encode("utf-8"))
+
+    @staticmethod
+    def save_head(directory, datecode, entry_list):
+        """
+        Save entry_list as the head, the materialized data for the latest datecode in
+        the meta file, so the pipeline doesn't have to rebuild it every day
+
+        Both files are written under temporary names and renamed into place. If we die
+        between the two renames the checksum won't match and the head is simply rebuilt
+        """
+        checksum = DiffEntryHistory.head_checksum(datecode)
+
+        write_entries(temporary_name(f"{directory}/_head.tsv"), entry_list, checksum)
+        os.replace(temporary_name(f"{directory}/_head.tsv"), f"{directory}/_head.tsv")
 
-        data = []
+        write_lines(f"{directory}/_head.txt", [datecode, checksum.hexdigest()])
+
+    @staticmethod
+    def open_head(directory, datecode):
+        """
+        Load the head saved for datecode
+
+        :return: The head as an EntryList, or None if it is missing, belongs to another
+        datecode or fails its checksum
+        """
+        if not os.path.exists(f"{directory}/_head.txt") or not os.path.exists(f"{directory}/_head.tsv"):
+            return None
 
-        for n in range(1, len(meta)):
-            diff_el = DiffEntryList.open(f"{directory}/{meta[n - 1]}-{meta[n]}.tsv")
-            data.append(diff_el)
+        with open(f"{directory}/_head.txt") as f:
+            lines = f.read().split()
+
+        if len(lines) != 2 or lines[0] != datecode:
+            return None
+
+        # Check the whole file before parsing any of it
+        checksum = DiffEntryHistory.head_checksum(datecode)
+        with open(f"{directory}/_head.tsv") as f:
+            for line in f:
+                checksum.update(line.encode("utf-8"))
+
+        if checksum.hexdigest() != lines[1]:
+            return None
+
+        return EntryList.open(f"{directory}/_head.tsv")
+
+    def write_keyframe(self, n):
+        """
+        Materialize the n-th index as a keyframe
+        """
+        if n <= 0:
+            # The root already serves as the keyframe for index 0
+            return
+
+        datecode = self.meta[n]
+        if self.archive is not None:
+            self.archive.append_keyframe(datecode, self.rebuild(n))
+        else:
+            DiffEntryHistory.save_keyframe(self.directory, datecode, self.rebuild(n))
 
-        return DiffEntryHistory(root=root, meta=meta, data=data, directory=directory)
+        if datecode not in self.keyframes:
+            self.keyframes.append(datecode)
+            bisect.insort(self._keyframe_indices, n)
+
+    def update_keyframes(self, interval=KEYFRAME_INTERVAL):
+        """
+        Write any keyframes missing from every interval-th index, eg to bring an
+        archive from before keyframes existed up to date
+        """
+        for n in range(interval, len(self.meta), interval):
+            if self.meta[n] not in self.keyframes:
+                self.write_keyframe(n)
 
     def rebuild(self, n=-1, datecode=None):
         """
         Use DiffEntryLists to reconstruct a data set at a particular point
 
+        Results are cached. Otherwise this starts from whichever is latest at or before
+        n out of the cached snapshots, the keyframes and the root
+
         :param n: the index to rebuild to
         """
         if datecode:
@@ -283,74 +1034,379 @@ class DiffEntryHistory:
                 raise ValueError(f"Datecode {datecode} not in this DiffEntryHistory")
         elif n == -1:
             n = len(self)
-        start = EntryList(self.root.data)
+        n = min(max(n, 0), len(self))
+
+        # An empty slice has no datecode to cache under
+        datecode = self.meta[n] if n < len(self.meta) else None
 
-        for diff_el in self:
-            if self.data.index(diff_el) >= n:
-                break
+        if datecode:
+            cached = self.cache.get(datecode)
+            if cached is not None:
+                return cached
+
+        k = bisect.bisect_right(self._keyframe_indices, n)
+        keyframe = self._keyframe_indices[k - 1] if k else 0
+
+        # A cached snapshot between the keyframe and n saves replaying even more
+        closest = keyframe
+        for cached_datecode in self.cache.datecodes():
+            position = self._positions.get(cached_datecode, -1)
+            if closest < position <= n:
+                closest = position
+
+        if closest > keyframe:
+            start = self.cache.peek(self.meta[closest])
+        elif k:
+            start = self.load_snapshot(self.meta[keyframe])
+        else:
+            start = EntryList(self.root.data)
+
+        for diff_el in self.data[closest:n]:
             start.process_diff(diff_el)
 
+        if datecode:
+            self.cache.put(datecode, start)
+
         return start
 
-    def rebase(self, n):
+    def rebuild_many(self, datecodes=None, copy=False):
+        """
+        Rebuild several days in a single pass over the history, rather than replaying
+        from the root or a keyframe for each one, so sweeping every day only costs as
+        much as all of the DiffEntryLists put together
+
+        By default each day is yielded as the same EntryList, which is rolled forward
+        to the next day as soon as iteration continues. Don't modify it, and pass
+        copy=True if you need to hold on to the days
+
+        :param datecodes: The days to rebuild in any order, defaults to every day
+        :return: An iterator of (datecode, EntryList) pairs, oldest first
+        """
+        if datecodes is None:
+            datecodes = self.meta
+
+        for datecode in datecodes:
+            if datecode not in self._positions:
+                raise ValueError(f"Datecode {datecode} not in this DiffEntryHistory")
+
+        positions = sorted({self._positions[datecode] for datecode in datecodes})
+        return self._replay(positions, copy)
+
+    def _replay(self, positions, copy):
+        if not positions:
+            return
+
+        # Only the first day needs a real rebuild, everything after it is replayed
+        current = self.rebuild(positions[0])
+        n = positions[0]
+
+        for position in positions:
+            for diff_el in self.data[n:position]:
+                current.process_diff(diff_el)
+            n = position
+
+            yield self.meta[position], EntryList(current.data) if copy else current
+
+    def compose(self, datecode0, datecode1):
+        """
+        Fold the DiffEntryLists between two datecodes into a single net DiffEntryList,
+        without rebuilding either day. An addition and a later matching removal cancel
+        out, as do a removal and a later matching addition
+
+        If datecode0 is after datecode1, the result is reversed so it still reads as
+        going from datecode0 to datecode1
+
+        :return: A DiffEntryList with the removals first, then the additions
+        """
+        for datecode in (datecode0, datecode1):
+            if datecode not in self._positions:
+                raise ValueError(f"Datecode {datecode} not in this DiffEntryHistory")
+
+        start = self._positions[datecode0]
+        stop = self._positions[datecode1]
+
+        if start > stop:
+            output = DiffEntryList()
+            for diff_entry in self.compose(datecode1, datecode0):
+                flipped = "+" if diff_entry.mode == "-" else "-"
+                output.append(DiffEntry(flipped + str(Entry(diff_entry))))
+            return DiffEntryList(output.removed().diff_entries + output.added().diff_entries)
+
+        # Key: the DiffEntries not yet cancelled out, which all share a mode
+        pending = {}
+
+        for diff_el in self.data[start:stop]:
+            # Like process_diff, each day's additions go in before its removals
+            for diff_entry in diff_el.added().diff_entries + diff_el.removed().diff_entries:
+                key = diff_entry.key()
+                outstanding = pending.setdefault(key, [])
+
+                if outstanding and outstanding[0].mode != diff_entry.mode:
+                    # Cancel out the oldest one
+                    outstanding.pop(0)
+                else:
+                    outstanding.append(diff_entry)
+
+        output = DiffEntryList()
+        for mode in ("-", "+"):
+            for outstanding in pending.values():
+                for diff_entry in outstanding:
+                    if diff_entry.mode == mode:
+                        output.append(diff_entry)
+
+        return output
+
+    def rebase(self, n, compression=None, cold_compression="xz", buffer_size=None):
         """
-        Rebuild to the n-th index, save the root, and update the meta file. Also
-        saves a backup of the old meta file in case you didn't actually want to rebase.
+        Make the n-th index the new root, and update the meta file. Also saves a
+        backup of the old meta file in case you didn't actually want to rebase.
 
         This is unimplemented in the pipeline as of yet but can be run
         manually if your archive gets to be larger than like 500 differences.
 
-        This does not remove old diff files, it just excludes them from being loaded
-        the next time a DiffEntryHistory is opened. So you
+        The new root is folded together on disk from the latest keyframe at or before n,
+        see external_diff.fold_deltas, so this doesn't need the history in memory.
+        Everything before the new root is moved into a single compressed cold segment,
+        _cold_{first datecode}-{new root datecode}.tsv.xz, which restore_cold_segment
+        can put back
+
+        Every file is written under a temporary name and renamed into place, and the
+        meta file is replaced before anything is deleted, so stopping partway through
+        leaves either the old archive or the new one. This history is reloaded
+        afterwards, so it can go on being used, but slices taken from it beforehand can't
+
+        :param compression: An extension from compressed.CODECS to compress the new root with
+        :param cold_compression: The same for the cold segment
+        :param buffer_size: Roughly how many bytes of lines to hold in memory at once
+        """
+        if self.archive is not None:
+            raise ValueError("Cannot rebase a packed or SQLite archive, only loose files")
+
+        # Imported here since external_diff builds on this module
+        from external_diff import EXTERNAL_BUFFER_SIZE, fold_deltas
+
+        if n < 0:
+            n += len(self.meta)
+        n = min(max(n, 0), len(self))
+
+        if n == 0:
+            return
+
+        directory = self.directory
+        meta = self.meta
+
+        def diff_path(i):
+            return f"{directory}/{meta[i - 1]}-{meta[i]}.tsv"
+
+        # A keyframe at n is already the new root
+        k = bisect.bisect_right(self._keyframe_indices, n)
+        start = self._keyframe_indices[k - 1] if k else 0
+
+        if start < n:
+            filename = compressed_name(f"{directory}/{meta[n]}.tsv", compression)
+            fold_deltas(
+                f"{directory}/{meta[start]}.tsv", [diff_path(i) for i in range(start + 1, n + 1)],
+                temporary_name(filename), buffer_size or EXTERNAL_BUFFER_SIZE, directory
+            )
+            os.replace(temporary_name(filename), filename)
+
+        # The old root and each difference up to the new root, each after a "#datecode" line
+        segment = compressed_name(f"{directory}/{COLD_PREFIX}{meta[0]}-{meta[n]}.tsv", cold_compression)
+        with open_text(temporary_name(segment), "w") as f:
+            for i in range(n + 1):
+                f.write(f"#{meta[i]}\n")
+                with open_text(find_file(diff_path(i) if i else f"{directory}/{meta[0]}.tsv"), "r") as source:
+                    shutil.copyfileobj(source, f)
+        os.replace(temporary_name(segment), segment)
+
+        write_lines(f"{directory}/_meta_old.txt", meta)
+        write_lines(f"{directory}/_meta.txt", meta[n:])
+        if os.path.exists(f"{directory}/_keyframes.txt"):
+            write_lines(f"{directory}/_keyframes.txt", [datecode for datecode in self.keyframes if datecode in meta[n + 1:]])
+
+        # Only now that the new meta is in place can the old files go
+        dropped = [f"{directory}/{meta[0]}.tsv"] + [diff_path(i) for i in range(1, n + 1)]
+        dropped += [f"{directory}/{meta[i]}.tsv" for i in self._keyframe_indices if i < n]
+        for filepath in dropped:
+            filepath = find_file(filepath)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+        self.reload()
+
+    def reload(self):
         """
-        output = self[n:]
+        Read the meta, keyframes and differences from the directory again, after
+        something like rebase has changed them. Whatever was cached is dropped
+        """
+        history = DiffEntryHistory.open(
+            self.directory, getattr(self.data, "cache_size", DIFF_CACHE_SIZE), self.cache.budget
+        )
+        self.__dict__.update(history.__dict__)
 
-        filename = f"{output.directory}/{output.meta[0]}.tsv"
-        meta_path = f"{output.directory}/_meta.txt"
-        backup_meta = f"{output.directory}/_meta_old.txt"
+    @staticmethod
+    def restore_cold_segment(directory):
+        """
+        Undo the most recent rebase of the archive in directory, putting the files
+        from its cold segment back and adding their datecodes to the meta file
 
-        with open(filename, "w+") as f:
-            f.write(str(output.root))
+        :param directory: The archive's directory, or a DiffEntryHistory open on it,
+        which is reloaded once the files are back
+        :return: Whether there was a cold segment to restore
+        """
+        history = None
+        if isinstance(directory, DiffEntryHistory):
+            history, directory = directory, directory.directory
 
-        with open(meta_path, "w+") as f:
-            f.write("\n".join(output.meta) + "\n")
+        with open(f"{directory}/_meta.txt") as f:
+            meta = [line.strip() for line in f if line.strip()]
 
-        with open(backup_meta, "w+") as f:
-            f.write("\n".join(self.meta) + "\n")
+        segments = [
+            filename for filename in os.listdir(directory)
+            if filename.startswith(COLD_PREFIX) and filename.split(".")[0].endswith(f"-{meta[0]}")
+        ]
+        if not segments:
+            return False
 
-    def count_presence(self):
-        output = {}
+        segment = f"{directory}/{sorted(segments)[0]}"
+        restored = []
+        output = None
+
+        try:
+            with open_text(segment, "r") as f:
+                for line in f:
+                    if line.startswith("#"):
+                        if output is not None:
+                            output.close()
+                            os.replace(temporary_name(filename), filename)
+                            output = None
+
+                        # The old root comes first, then each difference in turn up
+                        # to the one leading to the current root
+                        datecode = line[1:].strip()
+                        if restored:
+                            filename = f"{directory}/{restored[-1]}-{datecode}.tsv"
+                        else:
+                            filename = f"{directory}/{datecode}.tsv"
+
+                        restored.append(datecode)
+                        output = open_text(temporary_name(filename), "w")
+                    else:
+                        output.write(line)
+        finally:
+            if output is not None:
+                output.close()
+                os.replace(temporary_name(filename), filename)
+
+        write_lines(f"{directory}/_meta.txt", restored[:-1] + meta)
+        os.remove(segment)
+
+        # The root the rebase made is just another day again, so it can go now that the
+        # meta file no longer points at it, unless it's also a keyframe
+        keyframes = []
+        if os.path.exists(f"{directory}/_keyframes.txt"):
+            with open(f"{directory}/_keyframes.txt") as f:
+                keyframes = [line.strip() for line in f if line.strip()]
+
+        root = find_file(f"{directory}/{meta[0]}.tsv")
+        if meta[0] not in keyframes and os.path.exists(root):
+            os.remove(root)
+
+        if history is not None:
+            history.reload()
+        return True
+
+    def dpsst_index(self):
+        """
+        The DpsstIndex for this history, loaded from disk if it's up to date
+        """
+        if self._dpsst_index is None:
+            # Imported here since indexes builds on this module
+            from indexes import DpsstIndex
+            self._dpsst_index = DpsstIndex.load(self)
+        return self._dpsst_index
 
-        for entry in self.root:
-            if entry.dpsst_num in output:
-                output[entry.dpsst_num]["+"].append(entry)
-            else:
-                output[entry.dpsst_num] = {"+": EntryList([entry]), "-": EntryList()}
+    def get_by_dpsst_num(self, dpsst_num, n=-1, datecode=None):
+        """
+        Get the entries for a DPSST number as of the n-th index or datecode, without
+        rebuilding anything else
+        """
+        if not datecode:
+            if n == -1:
+                n = len(self)
+            datecode = self.meta[min(max(n, 0), len(self))]
+        elif datecode not in self.meta:
+            raise ValueError(f"Datecode {datecode} not in this DiffEntryHistory")
 
-        for diff_entry_list in self:
-            for diff_entry in diff_entry_list:
-                entry = Entry(diff_entry)
+        return self.dpsst_index().get_by_dpsst_num(dpsst_num, datecode)
 
-                if entry.dpsst_num not in output:
-                    output[entry.dpsst_num] = {"+": EntryList(), "-": EntryList()}
+    def timeline(self, dpsst_num):
+        """
+        Everything that happened to a DPSST number over the history
 
-                output[entry.dpsst_num][diff_entry.mode].append(entry)
+        :return: A list of (datecode, mode, Entry) tuples, oldest first
+        """
+        return self.dpsst_index().timeline(dpsst_num)
 
-        output2 = EntryList()
+    def presence_index(self):
+        """
+        The PresenceIndex for this history, loaded from disk if it's up to date
+        """
+        if self._presence_index is None:
+            # Imported here since indexes builds on this module
+            from indexes import PresenceIndex
+            self._presence_index = PresenceIndex.load(self)
+        return self._presence_index
+
+    def present_as_of(self, datecode):
+        """
+        Everything listed as of datecode, without rebuilding. Unlike rebuild, datecode
+        doesn't need to be one of the days in the history
+        """
+        return self.presence_index().as_of(datecode)
+
+    def present_during(self, start, end, whole=False):
+        """
+        Everything listed at some point in [start, end), or for all of it if whole
+        """
+        return self.presence_index().during(start, end, whole)
+
+    def _query_snapshot(self, n, datecode):
+        if not datecode:
+            if n == -1:
+                n = len(self)
+            datecode = self.meta[min(max(n, 0), len(self))]
+
+        if self._queried is None or self._queried[0] != datecode:
+            self._queried = (datecode, self.rebuild(datecode=datecode))
+        return self._queried[1]
 
-        for dpsst_num in output:
-            if len(output[dpsst_num]["+"]) == len(output[dpsst_num]["-"]):
+    def where(self, n=-1, datecode=None, **filters):
+        """
+        Get the entries matching every filter as of the n-th index or datecode, see
+        EntryList.where
+        """
+        return self._query_snapshot(n, datecode).where(**filters)
 
-                # Get PPB entry if it exists
-                is_ppb = False
-                for entry in output[dpsst_num]["+"]:
-                    if entry.agency == "Portland Police Bureau":
-                        output2.append(entry)
-                        is_ppb = True
-                        break
+    def count(self, n=-1, datecode=None, **filters):
+        """
+        Count the entries matching every filter as of the n-th index or datecode
+        """
+        return self._query_snapshot(n, datecode).count(**filters)
 
-                # Otherwise, just take an arbitrary one
-                if not is_ppb:
-                    output2.append(output[dpsst_num]["+"][0])
+    def group_by(self, field, n=-1, datecode=None, **filters):
+        """
+        Count the entries matching every filter as of the n-th index or datecode by
+        the value of field, see EntryList.group_by
+        """
+        return self._query_snapshot(n, datecode).group_by(field, **filters)
 
-        return output2
+    def count_presence(self):
+        """
+        Find the DPSST numbers which have been removed as many times as they were added,
+        ie are not currently present, with a Portland Police Bureau entry for each where
+        there is one
+        """
+        # Imported here since indexes builds on this module
+        from indexes import MissingSummary
+        return MissingSummary.load(self).missing()
@@ -0,0 +1,221 @@
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import groupby, islice
+
+from compressed import find_file, open_text
+from diffy import Entry, DiffEntryList, read_diff_entries
+
+"""
+Differencing for snapshots too big to hold in memory, working on the TSV files
+directly rather than on EntryLists.
+
+Both files are sorted on disk by the fields Entries are compared on, in runs of
+at most buffer_size bytes, then merged and walked side by side in a single pass.
+fold_deltas does the same for rebuilding a snapshot from its difference files.
+
+The results are sorted back into their original order, so the output is exactly
+what EntryList.diff and DiffEntryList.from_diff(..., modified=False) would give for
+the same two files. Changes aren't paired up into modified records, but
+DiffEntryList reads both forms the same way.
+"""
+
+# How many bytes of lines to sort in memory at once
+EXTERNAL_BUFFER_SIZE = 64 << 20
+
+
+def external_sort(lines, key, buffer_size=EXTERNAL_BUFFER_SIZE, directory=None):
+    """
+    Yield lines sorted by key, holding at most about buffer_size bytes of them in
+    memory. Lines which compare equal keep their original order
+
+    :param lines: Lines without their trailing newlines
+    :param directory: Where to keep the sorted runs while they're merged
+    """
+    runs = []
+    chunk = []
+    size = 0
+
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            runs.append(_write_run(sorted(chunk, key=key), directory))
+            chunk = []
+            size = 0
+
+    if chunk:
+        runs.append(_write_run(sorted(chunk, key=key), directory))
+
+    files = [open(run, "r") for run in runs]
+    try:
+        yield from heapq.merge(*[(line[:-1] for line in f) for f in files], key=key)
+    finally:
+        for f in files:
+            f.close()
+        for run in runs:
+            os.remove(run)
+
+
+def _write_run(lines, directory):
+    handle, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(handle, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+    return path
+
+
+def _numbered(filepath):
+    # Tag each line with its position so the original order can be restored later
+    with open_text(find_file(filepath), "r") as f:
+        for n, line in enumerate(f):
+            line = line.rstrip("\n")
+            yield f"{n}\t{line}"
+
+
+def _entry_key(record):
+    n, line = record.split("\t", 1)
+    return Entry(line).key(), int(n)
+
+
+def _group_key(record):
+    return Entry(record.split("\t", 1)[1]).key()
+
+
+def _position(record):
+    return int(record.split("\t", 1)[0])
+
+
+def _write_changes(f, mode, records):
+    for record in records:
+        n, line = record.split("\t", 1)
+        f.write(f"{n}\t{mode}{Entry(line)}\n")
+
+
+def diff_files(filepath0, filepath1, output_path, buffer_size=EXTERNAL_BUFFER_SIZE, temp_directory=None, log=True):
+    """
+    Difference two snapshot TSVs without loading either of them, and write the
+    result to output_path in the same format as repo/diff/{d0}-{d1}.tsv
+
+    As with EntryList.diff, filepath0 must be the earlier of the two. Any of the files
+    can be compressed, see compressed.py
+
+    :param buffer_size: Roughly how many bytes of lines are held in memory at once
+    :param temp_directory: Where to put the sorted runs, defaults to the system's temp directory
+    """
+    if log:
+        print("Differencing files...")
+
+    work = tempfile.mkdtemp(dir=temp_directory)
+
+    try:
+        old = groupby(external_sort(_numbered(filepath0), _entry_key, buffer_size, work), _group_key)
+        new = groupby(external_sort(_numbered(filepath1), _entry_key, buffer_size, work), _group_key)
+
+        removed_path = f"{work}/removed.tsv"
+        added_path = f"{work}/added.tsv"
+
+        with open(removed_path, "w") as removed, open(added_path, "w") as added:
+            a = next(old, None)
+            b = next(new, None)
+
+            while a is not None or b is not None:
+                if b is None or (a is not None and a[0] < b[0]):
+                    _write_changes(removed, "-", a[1])
+                    a = next(old, None)
+                elif a is None or b[0] < a[0]:
+                    _write_changes(added, "+", b[1])
+                    b = next(new, None)
+                else:
+                    # Duplicates pair up earliest first, anything left over changed
+                    a_group = list(a[1])
+                    b_group = list(b[1])
+                    matched = min(len(a_group), len(b_group))
+
+                    _write_changes(removed, "-", a_group[matched:])
+                    _write_changes(added, "+", b_group[matched:])
+
+                    a = next(old, None)
+                    b = next(new, None)
+
+        # Put both halves back in the order they appeared in their files
+        with open_text(output_path, "w+") as output:
+            for path in (removed_path, added_path):
+                with open(path, "r") as f:
+                    lines = (line[:-1] for line in f)
+                    for record in external_sort(lines, _position, buffer_size, work):
+                        output.write(record.split("\t", 1)[1] + "\n")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if log:
+        print(f"Difference saved to {output_path}")
+
+
+def _copies(snapshot_path, diff_paths):
+    # Every copy of an entry tagged with where it came from, so that sorting on
+    # the tag gives the order process_diff would have left them in
+    with open_text(find_file(snapshot_path), "r") as f:
+        for seq, line in enumerate(f):
+            line = line.rstrip("\n")
+            yield f"{seq}\t{Entry(line)}"
+
+    for day, path in enumerate(diff_paths, 1):
+        seq = 0
+        for chunk in read_diff_entries(path):
+            for diff_entry in DiffEntryList(chunk):
+                if diff_entry.mode == "+":
+                    yield f"{day << 32 | seq}\t{Entry(diff_entry)}"
+                    seq += 1
+
+
+def _removals(diff_paths):
+    for path in diff_paths:
+        for chunk in read_diff_entries(path):
+            for diff_entry in DiffEntryList(chunk):
+                if diff_entry.mode == "-":
+                    yield str(Entry(diff_entry))
+
+
+def _line_key(line):
+    return Entry(line).key()
+
+
+def fold_deltas(snapshot_path, diff_paths, output_path, buffer_size=EXTERNAL_BUFFER_SIZE, temp_directory=None):
+    """
+    Apply each difference file in diff_paths to the snapshot TSV at snapshot_path in
+    turn, and write the result to output_path. This gives exactly what rebuilding
+    with EntryLists would, without loading the snapshot or any of the differences
+
+    A removal always takes the earliest copy of an entry still listed, so the k-th
+    removal of an entry takes its k-th copy. Each entry keeps the copies it has
+    beyond however many times it was removed
+
+    :param buffer_size: Roughly how many bytes of lines are held in memory at once
+    :param temp_directory: Where to put the sorted runs, defaults to the system's temp directory
+    """
+    work = tempfile.mkdtemp(dir=temp_directory)
+
+    def survivors():
+        copies = groupby(external_sort(_copies(snapshot_path, diff_paths), _entry_key, buffer_size, work), _group_key)
+        removals = groupby(external_sort(_removals(diff_paths), _line_key, buffer_size, work), _line_key)
+
+        removal = next(removals, None)
+        for key, group in copies:
+            while removal is not None and removal[0] < key:
+                removal = next(removals, None)
+
+            removed = 0
+            if removal is not None and removal[0] == key:
+                removed = sum(1 for _ in removal[1])
+                removal = next(removals, None)
+
+            yield from islice(group, removed, None)
+
+    try:
+        with open_text(output_path, "w") as output:
+            for record in external_sort(survivors(), _position, buffer_size, work):
+                output.write(record.split("\t", 1)[1] + "\n")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
@@ -0,0 +1,140 @@
+import os
+import re
+import shutil
+
+from bpl_scraper import bpl_url, letter_combos
+from diffy import temporary_name
+from http_scraper import WebFormsSession, scrape_from_all_pages
+
+"""
+Recording the search page, so the scrapers can be tried out and timed against
+the real thing without going back to it.
+
+record_corpus searches for each term once over HTTP and saves every page of
+results exactly as the site sent it, laid out like
+
+    corpus/_search.html     the page before anything is searched
+    corpus/ab/001.html      the first page of results for ab
+    corpus/ab/002.html      and so on
+
+mock_bpl.MockBplServer(corpus="corpus") then serves those pages back.
+"""
+
+SEARCH_PAGE = "_search.html"
+
+# Where the hidden fields keep their values, to swap in the mock's own
+STATE_FIELDS = {
+    name: re.compile(r'(<input[^>]*name="' + name + r'"[^>]*value=")[^"]*(")')
+    for name in ("__VIEWSTATE", "__EVENTVALIDATION")
+}
+
+
+class RecordingSession(WebFormsSession):
+    """
+    A WebFormsSession which keeps the HTML of each page of results it loads, by page
+    number, in recorded
+    """
+
+    def __init__(self, url=bpl_url, pool=None):
+        self.recorded = {}
+        super().__init__(url, pool)
+
+    def load(self, page):
+        super().load(page)
+        self.recorded[self.results.current_page or 1] = self.raw_page
+
+
+def record_corpus(directory, search_terms=None, url=bpl_url, overwrite=False, log=True):
+    """
+    Save every page of results for each search term, see the top of this module.
+    Terms already in directory are skipped unless overwrite, so an interrupted
+    recording can be picked up again
+
+    :param search_terms: Every two letter combination if not given
+    :param url: The search page, the real one unless told otherwise
+    """
+    if search_terms is None:
+        search_terms = letter_combos
+
+    os.makedirs(directory, exist_ok=True)
+
+    session = RecordingSession(url)
+    session.open()
+
+    with open(f"{directory}/{SEARCH_PAGE}", "wb") as f:
+        f.write(session.raw_page)
+
+    for search_term in search_terms:
+        term_directory = f"{directory}/{search_term}"
+        if os.path.isdir(term_directory) and not overwrite:
+            continue
+
+        session.recorded = {}
+        scrape_from_all_pages(session, search_term)
+
+        # Written somewhere else first, so a term is either all there or not at all
+        temporary_directory = temporary_name(term_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        os.makedirs(temporary_directory)
+
+        for page_number, page in sorted(session.recorded.items()):
+            with open(f"{temporary_directory}/{page_number:03}.html", "wb") as f:
+                f.write(page)
+
+        shutil.rmtree(term_directory, ignore_errors=True)
+        os.replace(temporary_directory, term_directory)
+
+        if log:
+            print(f"Recorded {len(session.recorded)} pages for {search_term}")
+
+    session.quit()
+
+
+class FixtureCorpus:
+    """
+    The pages record_corpus saved, read from disk as they're asked for
+    """
+
+    def __init__(self, directory):
+        if not os.path.exists(f"{directory}/{SEARCH_PAGE}"):
+            raise ValueError(f"{directory} is not a recorded corpus")
+
+        self.directory = directory
+        self._pages = {}
+
+    @property
+    def terms(self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.isdir(f"{self.directory}/{name}") and not name.startswith("_")
+        )
+
+    def search_page(self):
+        with open(f"{self.directory}/{SEARCH_PAGE}", "rb") as f:
+            return f.read().decode("utf-8")
+
+    def pages(self, search_term):
+        """
+        :return: Every page of results recorded for search_term, in order
+        """
+        if search_term not in self._pages:
+            term_directory = f"{self.directory}/{search_term}"
+            if not os.path.isdir(term_directory):
+                raise ValueError(f"Nothing was recorded for {search_term}")
+
+            pages = []
+            for filename in sorted(os.listdir(term_directory)):
+                with open(f"{term_directory}/{filename}", "rb") as f:
+                    pages.append(f.read().decode("utf-8"))
+            self._pages[search_term] = pages
+
+        return self._pages[search_term]
+
+
+def replace_state(page, viewstate, validation):
+    """
+    :return: page with its __VIEWSTATE and __EVENTVALIDATION swapped for the ones given
+    """
+    for name, value in (("__VIEWSTATE", viewstate), ("__EVENTVALIDATION", validation)):
+        page = STATE_FIELDS[name].sub(lambda match: match.group(1) + value + match.group(2), page, count=1)
+    return page
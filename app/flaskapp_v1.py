@@ -1,9 +1,10 @@
 import os
 
-from flask import Flask, render_template, send_from_directory
+from flask import Flask, abort, render_template, request, send_from_directory
 from waitress import serve
 
 from diffy import EntryList, DiffEntryHistory, DiffEntryList
+from indexes import MissingSummary
 
 app = Flask(__name__)
 
@@ -22,7 +23,8 @@ print(f"Loading primary DiffEntryHistory...")
 
 diff_eh = DiffEntryHistory.open("repo/diff")
 
-count = diff_eh.count_presence()
+# Kept up to date by the pipeline, so this doesn't need to walk the history
+missing = MissingSummary.load(diff_eh)
 
 print(f"Load complete.")
 
@@ -71,11 +73,32 @@ def favicon():
 def front_page():
     return render_template(
         "summary.html",
-        entries=count,
+        entries=missing.missing(),
         today=diff_eh.meta[-1]
     )
 
 
+@app.route("/compare")
+def compare_page():
+    # Defaults to the whole span of the archive
+    start = request.args.get("from", diff_eh.meta[0])
+    stop = request.args.get("to", diff_eh.meta[-1])
+
+    if start not in diff_eh.meta or stop not in diff_eh.meta:
+        abort(404)
+
+    diff_list = diff_eh.compose(start, stop)
+
+    return render_template(
+        "compare.html",
+        datecodes=diff_eh.meta,
+        start=start,
+        stop=stop,
+        added=diff_list.added(),
+        removed=diff_list.removed()
+    )
+
+
 @app.route("/<datecode>")
 def go_to_page(datecode):
     return construct_template(datecode)
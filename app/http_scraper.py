@@ -0,0 +1,364 @@
+import gzip
+import http.client
+import re
+import threading
+from html.parser import HTMLParser
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from bpl_scraper import bpl_url
+from results_parser import parse_results_page
+
+"""
+Scraping CJ IRIS without a browser.
+
+EmployeeSearch.aspx is an ASP.NET WebForms page, so everything it does is a form
+post: searching submits txtNameSearch, and the pager's links call __doPostBack,
+which submits the form again with __EVENTTARGET and __EVENTARGUMENT set to eg
+gvResults and Page$3. Each post has to carry the __VIEWSTATE and
+__EVENTVALIDATION from the page before it, which is what WebFormsSession keeps
+track of. Requests go over keep-alive connections from a ConnectionPool.
+
+The rows come out exactly as the selenium backend's do. That scrapes the page
+source the browser gives back, which isn't quite what the site sent, so the
+responses are tidied up to match, see browser_html and results_parser.browser_text.
+"""
+
+# Idle connections kept open to each host
+POOL_SIZE = 8
+
+# Seconds to wait on the site before giving up on a request
+TIMEOUT = 30
+
+USER_AGENT = "Mozilla/5.0 (compatible; cj-iris-watcher)"
+
+# What a request on a kept-alive connection runs into when the site has given up on
+# it. The request is tried again on a new connection, but only once
+STALE_CONNECTION_ERRORS = (ConnectionError,)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections, kept for reuse once a request is done with them.
+    Safe to share between threads, but each connection is only used by one at a time
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=TIMEOUT):
+        """
+        :param size: How many idle connections to keep per host, any more are closed
+        :param timeout: Seconds to wait on a connection before giving up
+        """
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        :return: An idle connection to netloc if there is one, otherwise a new one, and
+        whether it was reused
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, connection):
+        """
+        Hand a connection back once its response has been read
+        """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+
+
+# Shared by every session that isn't given its own
+default_pool = ConnectionPool()
+
+
+class FormParser(HTMLParser):
+    """
+    Pulls the first form out of a page: where it posts to, the values it would
+    submit, and its submit buttons
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.fields = {}
+        self.buttons = {}
+        self._in_form = False
+        self._done = False
+        self._select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        if tag == "form" and not self._done:
+            self._in_form = True
+            self.action = attrs.get("action") or ""
+        if not self._in_form:
+            return
+
+        name = attrs.get("name")
+
+        if tag == "input" and name:
+            input_type = (attrs.get("type") or "text").lower()
+            if input_type == "submit":
+                self.buttons[name] = attrs.get("value") or ""
+            elif input_type in ("radio", "checkbox"):
+                if "checked" in attrs:
+                    self.fields[name] = attrs.get("value") or "on"
+            elif input_type not in ("button", "image", "reset", "file"):
+                self.fields[name] = attrs.get("value") or ""
+        elif tag == "select" and name:
+            self._select = name
+        elif tag == "option" and self._select:
+            # The first option unless another one is selected
+            if self._select not in self.fields or "selected" in attrs:
+                self.fields[self._select] = attrs.get("value") or ""
+
+    def handle_endtag(self, tag):
+        if tag == "select":
+            self._select = None
+        elif tag == "form" and self._in_form:
+            self._in_form = False
+            self._done = True
+
+
+def browser_html(page):
+    """
+    A browser reads every line ending as a plain newline, so the lines come out the same
+    """
+    return page.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class WebFormsSession:
+    """
+    One visitor to the search page, posting the form back with whatever state the
+    last page left in it. Used like a selenium driver by bpl_scraper, so it has quit().
+    Nothing is fetched until open(), see open_session
+    """
+
+    def __init__(self, url=bpl_url, pool=None):
+        """
+        :param pool: A ConnectionPool, default_pool if not given
+        """
+        self.url = url
+        self.pool = default_pool if pool is None else pool
+        self.cookies = {}
+        self.page = None
+        self.raw_page = None
+        self.results = None
+        self.action = url
+        self.fields = {}
+        self.buttons = {}
+
+        # How many requests this session has made, for keeping an eye on things
+        self.requests = 0
+
+    def open(self):
+        """
+        Load the search page, which the first search is posted from
+        """
+        self.load(self.request("GET", self.url))
+
+    def request(self, method, url, body=None):
+        """
+        :return: The text of the response
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        headers = self.headers(body)
+        if body is not None:
+            body = body.encode("utf-8")
+
+        while True:
+            connection, reused = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not reused:
+                    raise
+            except Exception:
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(parts.scheme, parts.netloc, connection)
+
+        self.requests += 1
+
+        return self.read_response(method, url, response.status, response.reason, response.msg, data)
+
+    def headers(self, body=None):
+        """
+        :return: The headers to send with a request
+        """
+        headers = {
+            "Accept-Encoding": "gzip",
+            "User-Agent": USER_AGENT,
+        }
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return headers
+
+    def read_response(self, method, url, status, reason, headers, data):
+        """
+        Keep any cookies a response sets
+
+        :param headers: An email.message.Message, as http.client gives them
+        :return: The text of the response, as a browser would read it
+        """
+        for header in headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+        if status != 200:
+            raise ValueError(f"{method} {url} returned {status} {reason}")
+
+        if (headers.get("Content-Encoding") or "").lower() == "gzip":
+            data = gzip.decompress(data)
+
+        # Exactly what the site sent, for fixtures.record_corpus
+        self.raw_page = data
+
+        charset = re.search(r"charset=([\w-]+)", headers.get("Content-Type") or "")
+        return browser_html(data.decode(charset.group(1) if charset else "utf-8"))
+
+    def load(self, page):
+        """
+        Take up the form state left by a page, and read the results on it
+        """
+        parser = FormParser()
+        parser.feed(page)
+        parser.close()
+
+        if parser.action is None:
+            raise ValueError(f"No form found on {self.url}")
+
+        self.page = page
+        self.results = parse_results_page(page)
+        self.action = urljoin(self.url, parser.action)
+        self.fields = parser.fields
+        self.buttons = parser.buttons
+
+    def search_fields(self, search_term):
+        """
+        :return: What the form sends when search_term is typed into the box and enter is
+        pressed, which submits the first button
+        """
+        fields = dict(self.fields)
+        fields["txtNameSearch"] = search_term
+        fields["__EVENTTARGET"] = ""
+        fields["__EVENTARGUMENT"] = ""
+        for name, value in list(self.buttons.items())[:1]:
+            fields[name] = value
+        return fields
+
+    def postback_fields(self, target, argument):
+        """
+        :return: What __doPostBack sends when a link is clicked
+        """
+        fields = dict(self.fields)
+        fields["__EVENTTARGET"] = target
+        fields["__EVENTARGUMENT"] = argument
+        return fields
+
+    def submit(self, fields):
+        self.load(self.request("POST", self.action, urlencode(fields)))
+
+    def search(self, search_term):
+        self.submit(self.search_fields(search_term))
+
+    def postback(self, target, argument):
+        self.submit(self.postback_fields(target, argument))
+
+    def go_to_page(self, page_number):
+        """
+        Follow the pager's link to page_number
+
+        :return: Whether there was one
+        """
+        if page_number not in self.results.targets:
+            return False
+
+        self.postback(*self.results.targets[page_number])
+        return True
+
+    def pages_back_to_first(self):
+        """
+        The page numbers to go to, one at a time, to get back to the first page of
+        results. Searching stays on whatever page the last search got to. Each is
+        worked out from the page loaded, so go there before asking for the next
+        """
+        return self._pages_from(-1)
+
+    def pages_after(self):
+        """
+        Likewise for each page after the one loaded, until there are no more
+        """
+        return self._pages_from(1)
+
+    def _pages_from(self, step):
+        while self.results.current_page is not None and self.results.current_page + step in self.results.targets:
+            yield self.results.current_page + step
+
+    def quit(self):
+        # Connections go back to the pool after every request, so there's nothing to let go of
+        self.page = None
+        self.results = None
+
+
+def open_session(url=bpl_url, pool=None):
+    """
+    Start a WebFormsSession on the search page, the way bpl_scraper.open_driver
+    starts a browser
+    """
+    session = WebFormsSession(url, pool)
+    session.open()
+    return session
+
+
+def scrape_from_all_pages(session, search_term):
+    """
+    Collect entries from every page of the search result, the same way
+    bpl_scraper.scrape_from_all_pages does with a browser
+    """
+    session.search(search_term)
+
+    for page_number in session.pages_back_to_first():
+        session.go_to_page(page_number)
+
+    entries = list(session.results.rows)
+
+    for page_number in session.pages_after():
+        session.go_to_page(page_number)
+        entries += session.results.rows
+
+    return entries
@@ -0,0 +1,494 @@
+import bisect
+import os
+
+from diffy import Entry, EntryList, DiffEntryHistory, temporary_name
+
+"""
+Indexes derived from a DiffEntryHistory which are kept up to date by the pipeline
+and saved alongside the archive, so questions about the whole history don't need
+a pass over every DiffEntryList to answer.
+"""
+
+
+def last_marker(filepath):
+    """
+    Find the last complete "#datecode" line in filepath without reading the whole file
+
+    :return: The datecode and where the line after it starts, or None and 0 if there
+    isn't one
+    """
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b""
+
+        while position > 0:
+            step = min(65536, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+
+            # A marker cut off before its line ending doesn't count
+            found = tail.rfind(b"\n#")
+            while found != -1:
+                line_end = tail.find(b"\n", found + 1)
+                if line_end != -1:
+                    return tail[found + 2:line_end].decode("utf-8").strip(), position + line_end + 1
+                found = tail.rfind(b"\n#", 0, found)
+
+        if tail.startswith(b"#") and b"\n" in tail:
+            line_end = tail.find(b"\n")
+            return tail[1:line_end].decode("utf-8").strip(), line_end + 1
+
+    return None, 0
+
+
+class SavedIndex:
+    """
+    What the indexes saved alongside an archive have in common. Each is built from a
+    history in one pass, one add per event with the root counting as every entry
+    being added on its datecode, and kept up to date a day at a time with update.
+    meta holds the datecodes covered, so an index is up to date when it matches
+    the history's meta
+
+    Subclasses have a filename and provide add, read_line and records, which give the
+    lines after the "#datecode" ones. update and lines can be overridden if a day or
+    the file need handling differently
+    """
+
+    filename = None
+
+    def __init__(self):
+        self.meta = []
+
+    def add(self, datecode, mode, entry):
+        raise NotImplementedError
+
+    def update(self, datecode, diff_el):
+        """
+        Add a day's DiffEntryList to the index
+        """
+        for diff_entry in diff_el:
+            self.add(datecode, diff_entry.mode, Entry(diff_entry))
+        self.meta.append(datecode)
+
+    def read_line(self, line):
+        """
+        Take in a line of the saved file other than a "#datecode" one
+        """
+        raise NotImplementedError
+
+    def read_marker(self, datecode):
+        """
+        Take in a "#datecode" line of the saved file
+        """
+        self.meta.append(datecode)
+
+    def records(self):
+        raise NotImplementedError
+
+    def lines(self):
+        """
+        :return: The lines of the saved file, without line endings
+        """
+        for datecode in self.meta:
+            yield f"#{datecode}"
+        yield from self.records()
+
+    @classmethod
+    def build(cls, history):
+        """
+        Index a DiffEntryHistory in one pass over its root and DiffEntryLists
+        """
+        index = cls()
+
+        for entry in history.root:
+            index.add(history.meta[0], "+", entry)
+        index.meta.append(history.meta[0])
+
+        for n, diff_el in enumerate(history):
+            index.update(history.meta[n + 1], diff_el)
+
+        return index
+
+    @classmethod
+    def open(cls, directory):
+        """
+        :return: The saved index, or None if there isn't one
+        """
+        filepath = f"{directory}/{cls.filename}"
+        if not os.path.exists(filepath):
+            return None
+
+        index = cls()
+
+        with open(filepath, "r") as f:
+            for line in f:
+                # A last line with no line ending was never finished
+                if not line.endswith("\n"):
+                    break
+
+                line = line[:-1]
+                if line.startswith("#"):
+                    index.read_marker(line[1:])
+                else:
+                    index.read_line(line)
+
+        return index
+
+    @classmethod
+    def load(cls, history):
+        """
+        Get the saved index for history if it is up to date, otherwise build it and,
+        if history is a whole archive rather than a slice of one, save it
+        """
+        index = None
+        if history.directory:
+            index = cls.open(history.directory)
+
+        if index is not None and index.meta == history.meta:
+            return index
+
+        index = cls.build(history)
+        if history.directory and DiffEntryHistory.open(history.directory).meta == history.meta:
+            index.save(history.directory)
+
+        return index
+
+    @classmethod
+    def roll_forward(cls, directory, history, datecode, diff_el):
+        """
+        Add a new day to the index saved in directory, or rebuild it from the whole
+        archive if it had fallen behind
+
+        :param history: The archive as it was before the day was added
+        """
+        index = cls.open(directory)
+        if index is not None and index.meta == history.meta:
+            index.update(datecode, diff_el)
+        else:
+            index = cls.build(DiffEntryHistory.open(directory))
+        index.save(directory)
+
+    def save(self, directory):
+        filepath = f"{directory}/{self.filename}"
+        with open(temporary_name(filepath), "w") as f:
+            for line in self.lines():
+                f.write(f"{line}\n")
+        os.replace(temporary_name(filepath), filepath)
+
+
+class DpsstIndex(SavedIndex):
+    """
+    Every event in the history grouped by DPSST number, in the order they happened
+
+    An event is a (datecode, mode, Entry) tuple. The root counts as every entry being
+    added on its datecode
+
+    Saved as _dpsst_index.tsv, which is the history flattened into one log: each
+    day's DiffEntries followed by a "#datecode" line. New days are appended, and
+    since the marker is written last a day only counts once all of it is there
+    """
+
+    filename = "_dpsst_index.tsv"
+
+    def __init__(self):
+        super().__init__()
+        self.events = {}
+
+        # Lines read from the file, waiting on the "#datecode" line after them. They're
+        # only parsed then, since the last few may be from an append which never finished
+        self._unmarked = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def __contains__(self, dpsst_num):
+        return dpsst_num in self.events
+
+    def add(self, datecode, mode, entry):
+        if entry.dpsst_num in self.events:
+            self.events[entry.dpsst_num].append((datecode, mode, entry))
+        else:
+            self.events[entry.dpsst_num] = [(datecode, mode, entry)]
+
+    def timeline(self, dpsst_num):
+        """
+        :return: Every (datecode, mode, Entry) event for dpsst_num, oldest first
+        """
+        return list(self.events.get(dpsst_num, []))
+
+    def get_by_dpsst_num(self, dpsst_num, datecode=None):
+        """
+        Replay the events for one DPSST number to find their entries as of datecode,
+        in the same order DiffEntryHistory.rebuild would give them
+
+        :param datecode: Defaults to the latest datecode in the index
+        """
+        output = EntryList()
+        to_remove = []
+        current = None
+
+        for event_datecode, mode, entry in self.events.get(dpsst_num, []):
+            if datecode and event_datecode > datecode:
+                break
+
+            # Like process_diff, each day's additions go in before its removals
+            if event_datecode != current:
+                for removed in to_remove:
+                    output.remove(removed)
+                to_remove = []
+                current = event_datecode
+
+            if mode == "+":
+                output.append(entry)
+            else:
+                to_remove.append(entry)
+
+        for removed in to_remove:
+            output.remove(removed)
+
+        return output
+
+    def read_line(self, line):
+        self._unmarked.append(line)
+
+    def read_marker(self, datecode):
+        for line in self._unmarked:
+            self.add(datecode, line[0], Entry(line[1:]))
+        self._unmarked = []
+        super().read_marker(datecode)
+
+    def lines(self):
+        # Regroup the events by day to write them back out as a log
+        days = {datecode: [] for datecode in self.meta}
+        for events in self.events.values():
+            for datecode, mode, entry in events:
+                days[datecode].append((mode, entry))
+
+        for datecode in self.meta:
+            for mode, entry in days[datecode]:
+                yield f"{mode}{entry}"
+            yield f"#{datecode}"
+
+    @classmethod
+    def open(cls, directory):
+        index = super().open(directory)
+        if index is not None:
+            # Anything after the last marker is from an append which never finished
+            index._unmarked = []
+        return index
+
+    @staticmethod
+    def append(directory, datecode0, datecode1, diff_el):
+        """
+        Append a new day to the saved index, provided it was up to date as of datecode0
+
+        :return: Whether the day was appended. If not, the index needs rebuilding
+        """
+        filepath = f"{directory}/{DpsstIndex.filename}"
+        if not os.path.exists(filepath):
+            return False
+
+        datecode, end = last_marker(filepath)
+        if datecode != datecode0:
+            return False
+
+        # Anything after the last marker is from an append which never finished
+        os.truncate(filepath, end)
+
+        with open(filepath, "a") as f:
+            for diff_entry in diff_el:
+                f.write(f"{diff_entry}\n")
+            f.write(f"#{datecode1}\n")
+
+        return True
+
+    @classmethod
+    def roll_forward(cls, directory, history, datecode, diff_el):
+        # Only the new day needs writing, unless the index had fallen behind
+        if not cls.append(directory, history.meta[-1], datecode, diff_el):
+            cls.build(DiffEntryHistory.open(directory)).save(directory)
+
+
+class MissingSummary(SavedIndex):
+    """
+    Running add and remove counts for every DPSST number, along with the entry that
+    would represent them on the summary page: their first Portland Police Bureau
+    entry if they have one, otherwise their first entry
+
+    A DPSST number which has been removed as many times as it was added is missing.
+    This gives the same results as walking the whole history, but a new day only
+    costs as much as its DiffEntryList
+
+    Saved as _missing.tsv: the datecodes covered as "#datecode" lines, then one
+    "added, removed, DPSST number, representative entry" line per DPSST number
+    """
+
+    filename = "_missing.tsv"
+
+    def __init__(self):
+        super().__init__()
+
+        # DPSST number: [added, removed, representative entry], in order of first appearance
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, datecode, mode, entry):
+        if entry.dpsst_num not in self.counts:
+            self.counts[entry.dpsst_num] = [0, 0, None]
+
+        counts = self.counts[entry.dpsst_num]
+
+        if mode == "+":
+            counts[0] += 1
+
+            representative = counts[2]
+            if representative is None or (
+                    representative.agency != "Portland Police Bureau" and entry.agency == "Portland Police Bureau"):
+                counts[2] = entry
+        else:
+            counts[1] += 1
+
+    def missing(self):
+        """
+        :return: An EntryList with the representative entry of every missing DPSST number
+        """
+        output = EntryList()
+        for added, removed, representative in self.counts.values():
+            if added == removed:
+                output.append(representative)
+        return output
+
+    def read_line(self, line):
+        added, removed, dpsst_num, representative = line.split("\t", 3)
+        representative = Entry(representative) if representative else None
+        self.counts[dpsst_num] = [int(added), int(removed), representative]
+
+    def records(self):
+        for dpsst_num, (added, removed, representative) in self.counts.items():
+            representative = str(representative) if representative is not None else ""
+            yield f"{added}\t{removed}\t{dpsst_num}\t{representative}"
+
+
+class PresenceIndex(SavedIndex):
+    """
+    Every stretch of time each entry was listed for, as [start, end) datecode
+    intervals. An end of None means the entry is still listed. An entry listed twice
+    at once has two overlapping intervals, and removals close the earliest one first
+    like EntryList.remove does. One added and removed on the same day never gets
+    an interval, since it was never listed as far as a rebuild is concerned
+
+    Intervals are kept sorted by start, so queries only look at the ones which had
+    started by then
+
+    Saved as _presence.tsv: the datecodes covered as "#datecode" lines, then one
+    "start, end, entry" line per interval with the end left blank if it's open
+    """
+
+    filename = "_presence.tsv"
+
+    def __init__(self):
+        super().__init__()
+
+        # [start, end, Entry], in the order they were opened, which is also sorted by start
+        self.intervals = []
+
+        # Entry key: its intervals, oldest first
+        self.by_entry = {}
+        self._starts = None
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, datecode, mode, entry):
+        if mode == "+":
+            interval = [datecode, None, entry]
+            self.intervals.append(interval)
+            self.by_entry.setdefault(entry.key(), []).append(interval)
+            self._starts = None
+        else:
+            intervals = self.by_entry.get(entry.key(), [])
+            for interval in intervals:
+                if interval[1] is None:
+                    if interval[0] < datecode:
+                        interval[1] = datecode
+                    else:
+                        # Added and removed on the same day, so it was never listed at all.
+                        # It was only just added, so it's near the end
+                        intervals.remove(interval)
+                        for n in range(len(self.intervals) - 1, -1, -1):
+                            if self.intervals[n] is interval:
+                                del self.intervals[n]
+                                break
+                        self._starts = None
+                    break
+
+    def update(self, datecode, diff_el):
+        """
+        Add a day's DiffEntryList to the index
+        """
+        # Like process_diff, the additions go in before the removals
+        for diff_entry in diff_el.added():
+            self.add(datecode, "+", Entry(diff_entry))
+        for diff_entry in diff_el.removed():
+            self.add(datecode, "-", Entry(diff_entry))
+        self.meta.append(datecode)
+
+    def _count_started(self, datecode, inclusive=True):
+        # How many intervals started by datecode, or before it if not inclusive
+        if self._starts is None:
+            self._starts = [interval[0] for interval in self.intervals]
+        if inclusive:
+            return bisect.bisect_right(self._starts, datecode)
+        return bisect.bisect_left(self._starts, datecode)
+
+    def as_of(self, datecode):
+        """
+        :return: An EntryList of everything listed as of datecode, which doesn't need
+        to be in the history. Days before the first one have nothing listed
+        """
+        output = EntryList()
+        for start, end, entry in self.intervals[:self._count_started(datecode)]:
+            if end is None or end > datecode:
+                output.append(entry)
+        return output
+
+    def during(self, start, end, whole=False):
+        """
+        Find everything listed at any point in [start, end)
+
+        :param whole: Only include entries which were listed for all of [start, end)
+        :return: An EntryList with an entry for each matching interval
+        """
+        output = EntryList()
+
+        if whole:
+            # Only intervals which had started by start can cover all of it
+            for interval_start, interval_end, entry in self.intervals[:self._count_started(start)]:
+                if interval_end is None or interval_end >= end:
+                    output.append(entry)
+        else:
+            for interval_start, interval_end, entry in self.intervals[:self._count_started(end, False)]:
+                if interval_end is None or interval_end > start:
+                    output.append(entry)
+
+        return output
+
+    def intervals_for(self, entry):
+        """
+        :return: The (start, end) intervals entry was listed for, oldest first
+        """
+        return [(start, end) for start, end, other in self.by_entry.get(entry.key(), [])]
+
+    def read_line(self, line):
+        start, end, entry = line.split("\t", 2)
+        interval = [start, end or None, Entry(entry)]
+        self.intervals.append(interval)
+        self.by_entry.setdefault(interval[2].key(), []).append(interval)
+
+    def records(self):
+        for start, end, entry in self.intervals:
+            yield f"{start}\t{end or ''}\t{entry}"
@@ -0,0 +1,357 @@
+import argparse
+import base64
+import hashlib
+import html
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from fixtures import FixtureCorpus, replace_state
+
+"""
+A stand-in for the CJ IRIS EmployeeSearch.aspx page, for trying the scrapers out
+without going anywhere near the real site.
+
+It only mimics what the scrapers rely on: the txtNameSearch box, the
+ListTableAnyHeight results grid and the ListFooter pager, which posts back
+Page$N through __doPostBack. Like a real WebForms page, the search term lives in
+__VIEWSTATE and a postback is refused unless __EVENTVALIDATION matches it. Also
+like the real page, a new search stays on the page the last one was on, and text
+is encoded the way .NET does it, apostrophes and all.
+
+The officers are made up by generate_officers, as many as you like, or the pages
+are played back from a corpus recorded by fixtures.record_corpus.
+"""
+
+# Rows per page of results, and page links per block of the pager
+PAGE_SIZE = 20
+PAGE_BUTTON_COUNT = 10
+
+# What the generated officers are made of
+SURNAME_PARTS = ["Ab", "Bar", "Cal", "Dun", "El", "Fitz", "Gar", "Hol", "Ing", "Jor", "Kel", "Lar", "Mc", "Nor",
+                 "Ol", "Par", "Quin", "Ros", "Sal", "Tor", "Ul", "Van", "Wes", "Xi", "Yar", "Zim"]
+SURNAME_ENDINGS = ["sen", "ley", "ton", "berg", "ez", "ard", "is", "o", "man", "worth"]
+GIVEN_NAMES = ["Alex", "Casey", "Jamie", "Jordan", "Morgan", "Riley", "Sam", "Taylor"]
+AGENCIES = ["Portland Police Bureau", "Eugene Police Department", "Multnomah County Sheriff's Office",
+            "Oregon State Police", "Parole & Probation - Lane County", "Salem Police Department"]
+RANKS = ["Police Officer", "Deputy Sheriff", "Sergeant", "Corrections Officer", "Parole & Probation Officer",
+         "Telecommunicator"]
+STATUSES = ["Active", "Inactive"]
+
+# The real page only shows so much of an agency's name
+AGENCY_LENGTH = 40
+
+
+def generate_officers(n=1000, seed=0):
+    """
+    Make up n officers in the order the real page lists them, sorted by name
+
+    :param seed: The same seed always gives the same officers
+    :return: A list of [name, dpsst_num, agency, rank, status], see scraped_row for
+    how they end up in a scrape
+    """
+    rng = random.Random(seed)
+    officers = []
+
+    for i in range(n):
+        surname = rng.choice(SURNAME_PARTS) + rng.choice(SURNAME_ENDINGS).lower()
+        name = f"{surname}, {rng.choice(GIVEN_NAMES)}"
+        officers.append([
+            name,
+            str(10000 + i),
+            rng.choice(AGENCIES)[:AGENCY_LENGTH],
+            rng.choice(RANKS),
+            rng.choice(STATUSES),
+        ])
+
+    officers.sort(key=lambda officer: officer[0].lower())
+
+    return officers
+
+
+def encode(text):
+    """
+    Encode text for the page the way .NET's HtmlEncode does
+    """
+    return html.escape(text, quote=False).replace("\"", "&quot;").replace("'", "&#39;")
+
+
+def scraped_row(officer):
+    """
+    :return: The officer as a scrape saves them. The scrapers keep the text the way a
+    browser shows it in the page source, which escapes less than .NET
+    """
+    return [html.escape(field, quote=False) for field in officer]
+
+
+def encode_state(term, page):
+    """
+    :return: The __VIEWSTATE and __EVENTVALIDATION for showing page of term's results
+    """
+    viewstate = base64.b64encode(json.dumps([term, page]).encode()).decode()
+    validation = base64.b64encode(hashlib.sha1(viewstate.encode()).digest()).decode()
+    return viewstate, validation
+
+
+def decode_state(viewstate, validation):
+    """
+    :return: The term and page a postback's __VIEWSTATE holds
+    """
+    term, page = json.loads(base64.b64decode(viewstate))
+    if encode_state(term, page)[1] != validation:
+        raise ValueError("Invalid postback or callback argument")
+    return term, page
+
+
+def render_pager(page, pages):
+    """
+    :return: The lines of the ListFooter row, or none at all if there's only one page
+    """
+    if pages <= 1:
+        return []
+
+    def link(to_page, text):
+        return f"<td><a href=\"javascript:__doPostBack(&#39;gvResults&#39;,&#39;Page${to_page}&#39;)\">{text}</a></td>"
+
+    first = (page - 1) // PAGE_BUTTON_COUNT * PAGE_BUTTON_COUNT + 1
+    last = min(first + PAGE_BUTTON_COUNT - 1, pages)
+
+    cells = []
+    if first > 1:
+        cells.append(link(first - 1, "..."))
+    for n in range(first, last + 1):
+        cells.append(f"<td><span>{n}</span></td>" if n == page else link(n, n))
+    if last < pages:
+        cells.append(link(last + 1, "..."))
+
+    return [
+        "<tr class=\"ListFooter\">",
+        "<td colspan=\"5\">",
+        "<table border=\"0\"><tr>",
+        "".join(cells),
+        "</tr></table>",
+        "</td>",
+        "</tr>",
+    ]
+
+
+def render_page(term="", page=1, rows=None):
+    """
+    :param rows: Every row found for term, or None before anything has been searched
+    :return: The page's HTML
+    """
+    if rows is not None:
+        pages = max((len(rows) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+        page = min(max(page, 1), pages)
+
+    lines = [
+        "<!DOCTYPE html>",
+        "<html>",
+        "<head><title>Employee Search</title></head>",
+        "<body>",
+        "<form method=\"post\" action=\"EmployeeSearch.aspx\" id=\"form1\">",
+    ]
+
+    viewstate, validation = encode_state(term, page)
+    lines += [
+        "<input type=\"hidden\" name=\"__EVENTTARGET\" id=\"__EVENTTARGET\" value=\"\" />",
+        "<input type=\"hidden\" name=\"__EVENTARGUMENT\" id=\"__EVENTARGUMENT\" value=\"\" />",
+        f"<input type=\"hidden\" name=\"__VIEWSTATE\" id=\"__VIEWSTATE\" value=\"{viewstate}\" />",
+        f"<input type=\"hidden\" name=\"__EVENTVALIDATION\" id=\"__EVENTVALIDATION\" value=\"{validation}\" />",
+        "<script type=\"text/javascript\">",
+        "function __doPostBack(eventTarget, eventArgument) {",
+        "    var form = document.getElementById('form1');",
+        "    form.__EVENTTARGET.value = eventTarget;",
+        "    form.__EVENTARGUMENT.value = eventArgument;",
+        "    form.submit();",
+        "}",
+        "</script>",
+        f"<input name=\"txtNameSearch\" type=\"text\" value=\"{encode(term)}\" id=\"txtNameSearch\" />",
+        "<input id=\"rdoSearchOption_0\" type=\"radio\" name=\"rdoSearchOption\" value=\"0\" checked=\"checked\" />"
+        "<label for=\"rdoSearchOption_0\">Name</label>",
+        "<input id=\"rdoSearchOption_1\" type=\"radio\" name=\"rdoSearchOption\" value=\"1\" />"
+        "<label for=\"rdoSearchOption_1\">DPSST #</label>",
+        "<input type=\"submit\" name=\"cmdSearch\" value=\"Search\" id=\"cmdSearch\" />",
+    ]
+
+    if rows is not None:
+        lines.append("<table class=\"ListTableAnyHeight\" cellspacing=\"0\" id=\"gvResults\">")
+        lines.append("<tr class=\"ListHeader\"><th>Name</th><th>DPSST #</th><th>Agency</th><th>Rank</th>"
+                     "<th>Status</th></tr>")
+
+        for i, row in enumerate(rows[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]):
+            name, dpsst_num, agency, rank, status = [encode(field) for field in row]
+            lines += [
+                "<tr>",
+                f"<td align=\"left\"><a href=\"EmployeeDetail.aspx?id={dpsst_num}\">{name}</a></td>"
+                f"<td>{dpsst_num}</td><td><a href=\"AgencyDetail.aspx\">{agency}</a></td><td>",
+                f"<span id=\"gvResults_lblRank_{i}\">{rank}</span>",
+                "</td><td>",
+                f"<span id=\"gvResults_lblStatus_{i}\">{status}</span>",
+                "</td>",
+                "</tr>",
+            ]
+
+        lines += render_pager(page, pages)
+        lines.append("</table>")
+
+    lines += [
+        "</form>",
+        "</body>",
+        "</html>",
+    ]
+
+    return "\n".join(lines) + "\n"
+
+
+class MockBplServer:
+    """
+    Serves the stand-in page from a background thread on localhost
+
+        with MockBplServer(generate_officers(5000)) as server:
+            scrape_all_data("20211101", "scrape", url=server.url, workers=4)
+    """
+
+    def __init__(self, officers=None, port=0, latency=0.0, corpus=None):
+        """
+        :param officers: As generate_officers makes them, 1000 generated ones by default
+        :param port: 0 to pick any free port
+        :param latency: Seconds to wait before answering each request, to feel more like the real thing
+        :param corpus: A directory recorded by fixtures.record_corpus to play back instead of officers
+        """
+        self.corpus = None if corpus is None else FixtureCorpus(corpus)
+        self.officers = generate_officers() if officers is None and corpus is None else officers or []
+        self.latency = latency
+
+        # How many pages have been served, for keeping an eye on the scrapers
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real site
+            protocol_version = "HTTP/1.1"
+            # The headers and the page go out separately, which would otherwise stall keep-alive clients
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond(200, server.render("", 1))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                form = {key: values[0] for key, values in parse_qs(body, keep_blank_values=True).items()}
+
+                try:
+                    self.respond(200, server.postback(form))
+                except (ValueError, KeyError) as e:
+                    self.respond(500, f"<html><body><h1>Server Error</h1><p>{html.escape(str(e))}</p></body></html>")
+
+            def respond(self, status, page):
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    server.requests += 1
+
+                data = page.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                try:
+                    self.end_headers()
+                    self.wfile.write(data)
+                except ConnectionError:
+                    # A scraper which timed out has already hung up
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/PublicInquiry_CJ/EmployeeSearch.aspx"
+
+    def search(self, term):
+        """
+        :return: Every officer whose name starts with term, as the real search does
+        """
+        term = term.lower()
+        return [officer for officer in self.officers if officer[0].lower().startswith(term)]
+
+    def postback(self, form):
+        """
+        :return: The page a submitted form leads to
+        """
+        viewstate, validation = form["__VIEWSTATE"], form["__EVENTVALIDATION"]
+        term, page = decode_state(viewstate, validation)
+
+        if form.get("__EVENTTARGET"):
+            # Paging keeps to the search in the viewstate, whatever's in the box now
+            argument = form.get("__EVENTARGUMENT", "")
+            if not argument.startswith("Page$"):
+                raise ValueError(f"Invalid postback argument {argument}")
+            page = int(argument[5:])
+        elif form.get("rdoSearchOption", "0") == "0":
+            # Searching keeps to the page it was on, which is why the scrapers go back to the first
+            term = form.get("txtNameSearch", "")
+        else:
+            raise ValueError("Only searching by name is supported")
+
+        return self.render(term, page)
+
+    def render(self, term, page):
+        """
+        :return: page of term's results, or the search page if term is empty
+        """
+        if self.corpus is None:
+            return render_page(term, page, self.search(term) if term else None)
+
+        if not term:
+            pages = [self.corpus.search_page()]
+        else:
+            pages = self.corpus.pages(term.lower())
+
+        # The recorded state means nothing here, so it's swapped for the mock's own
+        page = min(max(page, 1), len(pages))
+        return replace_state(pages[page - 1], *encode_state(term, page))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a stand-in for the CJ IRIS search page")
+    parser.add_argument("--officers", type=int, default=5000, help="How many officers to make up")
+    parser.add_argument("--corpus", help="Play back a corpus recorded by fixtures.record_corpus instead")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+    args = parser.parse_args()
+
+    officers = None if args.corpus else generate_officers(args.officers)
+
+    with MockBplServer(officers, port=args.port, latency=args.latency, corpus=args.corpus) as mock:
+        print(f"Serving {args.corpus or f'{len(mock.officers)} officers'} at {mock.url}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,484 @@
+import json
+import mmap
+import os
+import struct
+import sys
+
+from diffy import Entry, EntryList, DiffEntry, DiffEntryList, DiffEntryHistory, LazyDiffEntryLists, ModifiedEntry, \
+    DIFF_CACHE_SIZE, write_entries
+
+"""
+A single-file alternative to the loose TSV layout of a diff directory.
+
+An archive.pack file looks like this:
+
+    MAGIC
+    record, record, ...
+    index record
+    footer
+
+Every record is a kind byte, a length-prefixed datecode and a length-prefixed
+payload. The kinds are
+
+    S   new strings for the string table
+    R   the root snapshot
+    K   a keyframe snapshot
+    D   the DiffEntryList leading up to its datecode
+    I   the index, a JSON object mapping datecodes to payload offsets
+
+Rows store name and DPSST number inline and agency, rank and status as codes into
+the string table, since those only take a few hundred distinct values. A modified
+"~" row is followed by its changes, a count and then each field's position in
+ModifiedEntry.fields with its new value, so DiffEntryLists come back exactly as
+they were stored. The footer
+points at the index record, so opening an archive only reads the footer and the
+index no matter how many days it holds. Records carry their own datecodes, so if
+the index is ever lost it can be recovered by scanning the file.
+"""
+
+PACK_FILENAME = "archive.pack"
+
+MAGIC = b"CJIRIS01"
+
+# kind, datecode length, [datecode], payload length, [payload]
+RECORD_KIND = struct.Struct("<cB")
+RECORD_LENGTH = struct.Struct("<I")
+
+# Offset of the index record, then MAGIC again
+FOOTER = struct.Struct("<Q8s")
+
+STRING_LENGTH = struct.Struct("<H")
+ROW_CODES = struct.Struct("<III")
+ROW_COUNT = struct.Struct("<I")
+CHANGE = struct.Struct("<B")
+
+
+class PackedArchive:
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = []
+        self.root = None
+        self.deltas = {}
+        self.keyframes = {}
+        self.string_blocks = []
+        self.strings = []
+        self.codes = {}
+
+        self._file = None
+        self._mmap = None
+        self._index_offset = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isfile(f"{directory}/{PACK_FILENAME}")
+
+    @staticmethod
+    def open(directory):
+        """
+        Open the packed archive in directory, reading only its footer and index
+        """
+        archive = PackedArchive(f"{directory}/{PACK_FILENAME}")
+        archive._map()
+        archive._read_index()
+        return archive
+
+    @staticmethod
+    def create(directory, root_datecode, root):
+        """
+        Start a new packed archive in directory holding only a root snapshot
+        """
+        path = f"{directory}/{PACK_FILENAME}"
+        if os.path.exists(path):
+            raise ValueError(f"Won't overwrite existing archive {path}")
+
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+
+        archive = PackedArchive(path)
+        archive._index_offset = len(MAGIC)
+        archive._append("R", root_datecode, root)
+        return archive
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def history(self, cache_size=DIFF_CACHE_SIZE):
+        """
+        A DiffEntryHistory reading lazily from this archive
+        """
+        data = LazyDiffEntryLists(self.meta[1:], load=self.read_delta, cache_size=cache_size)
+        directory = os.path.dirname(self.path)
+        return DiffEntryHistory(
+            root=None, meta=list(self.meta), data=data, directory=directory,
+            keyframes=list(self.keyframes), archive=self
+        )
+
+    def read_snapshot(self, datecode):
+        """
+        Read the root or a keyframe as an EntryList
+        """
+        if datecode == self.meta[0]:
+            offset, length = self.root
+        elif datecode in self.keyframes:
+            offset, length = self.keyframes[datecode]
+        else:
+            raise ValueError(f"No snapshot for {datecode} in {self.path}")
+
+        return EntryList(self._decode_rows(offset, Entry))
+
+    def read_delta(self, datecode):
+        """
+        Read the DiffEntryList which ends at datecode
+        """
+        if datecode not in self.deltas:
+            raise ValueError(f"No DiffEntryList for {datecode} in {self.path}")
+
+        offset, length = self.deltas[datecode]
+        return DiffEntryList(self._decode_rows(offset, DiffEntry))
+
+    def append_delta(self, datecode, diff_el):
+        """
+        Add the next day's DiffEntryList to the end of the archive
+        """
+        if datecode in self.meta:
+            raise ValueError(f"Datecode {datecode} is already in {self.path}")
+        self._append("D", datecode, diff_el)
+
+    def append_keyframe(self, datecode, entry_list):
+        if datecode not in self.meta:
+            raise ValueError(f"Datecode {datecode} not in {self.path}")
+        self._append("K", datecode, entry_list)
+
+    def _map(self):
+        self.close()
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a packed archive")
+
+    def _read_record(self, position):
+        """
+        :return: kind, datecode, payload offset, payload length and where the next record starts
+        """
+        kind, datecode_length = RECORD_KIND.unpack_from(self._mmap, position)
+        position += RECORD_KIND.size
+
+        datecode = str(self._mmap[position:position + datecode_length], "ascii")
+        position += datecode_length
+
+        length, = RECORD_LENGTH.unpack_from(self._mmap, position)
+        position += RECORD_LENGTH.size
+
+        return kind.decode("ascii"), datecode, position, length, position + length
+
+    def _read_index(self):
+        footer_position = len(self._mmap) - FOOTER.size
+        if footer_position >= len(MAGIC):
+            index_offset, magic = FOOTER.unpack_from(self._mmap, footer_position)
+        else:
+            index_offset, magic = None, None
+
+        if magic != MAGIC:
+            # Interrupted partway through an append
+            self._recover_index()
+            return
+
+        kind, datecode, offset, length, end = self._read_record(index_offset)
+        index = json.loads(str(self._mmap[offset:end], "utf-8"))
+
+        self.meta = index["meta"]
+        self.root = tuple(index["root"])
+        self.deltas = {datecode: tuple(value) for datecode, value in index["deltas"].items()}
+        self.keyframes = {datecode: tuple(value) for datecode, value in index["keyframes"].items()}
+        self._index_offset = index_offset
+
+        self.string_blocks = [tuple(value) for value in index["strings"]]
+        self.strings = []
+        self.codes = {}
+        for offset, length in self.string_blocks:
+            self._load_strings(offset)
+
+    def _recover_index(self):
+        """
+        Rebuild the index by walking every complete record from the start of the file
+        """
+        self.meta = []
+        self.root = None
+        self.deltas = {}
+        self.keyframes = {}
+        self.string_blocks = []
+        self.strings = []
+        self.codes = {}
+
+        position = len(MAGIC)
+        last_good = position
+
+        while True:
+            try:
+                kind, datecode, offset, length, end = self._read_record(position)
+            except (struct.error, UnicodeDecodeError):
+                break
+            if end > len(self._mmap):
+                break
+
+            if kind == "S":
+                self.string_blocks.append((offset, length))
+                self._load_strings(offset)
+            elif kind == "R":
+                self.meta = [datecode]
+                self.root = (offset, length)
+            elif kind == "D":
+                self.meta.append(datecode)
+                self.deltas[datecode] = (offset, length)
+            elif kind == "K":
+                self.keyframes[datecode] = (offset, length)
+            elif kind != "I":
+                break
+
+            if kind != "I":
+                last_good = end
+            position = end
+
+        if self.root is None:
+            raise ValueError(f"{self.path} has no root snapshot")
+
+        # Anything past the last good record is garbage from the interrupted write
+        self._index_offset = last_good
+
+    def _load_strings(self, offset):
+        count, = ROW_COUNT.unpack_from(self._mmap, offset)
+        position = offset + ROW_COUNT.size
+
+        for _ in range(count):
+            length, = STRING_LENGTH.unpack_from(self._mmap, position)
+            position += STRING_LENGTH.size
+            string = sys.intern(str(self._mmap[position:position + length], "utf-8"))
+            position += length
+
+            self.codes[string] = len(self.strings)
+            self.strings.append(string)
+
+    def _decode_rows(self, offset, entry_type):
+        # Strings are decoded straight out of the mapped file without reading it into a buffer
+        view = memoryview(self._mmap)
+        strings = self.strings
+        rows = []
+
+        try:
+            count, = ROW_COUNT.unpack_from(view, offset)
+            position = offset + ROW_COUNT.size
+
+            for _ in range(count):
+                if entry_type is DiffEntry:
+                    mode = chr(view[position])
+                    position += 1
+
+                length, = STRING_LENGTH.unpack_from(view, position)
+                position += STRING_LENGTH.size
+                name = str(view[position:position + length], "utf-8")
+                position += length
+
+                length, = STRING_LENGTH.unpack_from(view, position)
+                position += STRING_LENGTH.size
+                dpsst_num = str(view[position:position + length], "utf-8")
+                position += length
+
+                agency, rank, status = ROW_CODES.unpack_from(view, position)
+                position += ROW_CODES.size
+
+                if entry_type is DiffEntry and mode == "~":
+                    entry = ModifiedEntry.from_fields(name, dpsst_num, strings[agency], strings[rank], strings[status])
+                    count, = CHANGE.unpack_from(view, position)
+                    position += CHANGE.size
+
+                    changes = []
+                    for _ in range(count):
+                        field, = CHANGE.unpack_from(view, position)
+                        position += CHANGE.size
+                        length, = STRING_LENGTH.unpack_from(view, position)
+                        position += STRING_LENGTH.size
+                        changes.append((ModifiedEntry.fields[field], str(view[position:position + length], "utf-8")))
+                        position += length
+                    entry.changes = tuple(changes)
+                else:
+                    entry = entry_type.from_fields(name, dpsst_num, strings[agency], strings[rank], strings[status])
+                if entry_type is DiffEntry:
+                    entry.mode = mode
+                rows.append(entry)
+        finally:
+            view.release()
+
+        return rows
+
+    def _encode_rows(self, entries, new_strings):
+        # Collect the rows first so that new strings are known before anything is written
+        rows = []
+        count = 0
+
+        # Modified records are kept as they are rather than as the pairs they stand for
+        if isinstance(entries, DiffEntryList):
+            entries = entries.diff_entries
+
+        for entry in entries:
+            if isinstance(entry, DiffEntry):
+                rows.append(entry.mode.encode("ascii"))
+
+            for field in (entry.name, entry.dpsst_num):
+                encoded = field.encode("utf-8")
+                rows.append(STRING_LENGTH.pack(len(encoded)))
+                rows.append(encoded)
+
+            codes = []
+            for field in (entry.agency, entry.rank, entry.status):
+                if field not in self.codes:
+                    self.codes[field] = len(self.strings)
+                    self.strings.append(field)
+                    new_strings.append(field)
+                codes.append(self.codes[field])
+            rows.append(ROW_CODES.pack(*codes))
+
+            if isinstance(entry, ModifiedEntry):
+                rows.append(CHANGE.pack(len(entry.changes)))
+                for field, value in entry.changes:
+                    encoded = value.encode("utf-8")
+                    rows.append(CHANGE.pack(ModifiedEntry.fields.index(field)))
+                    rows.append(STRING_LENGTH.pack(len(encoded)))
+                    rows.append(encoded)
+
+            count += 1
+
+        return ROW_COUNT.pack(count) + b"".join(rows)
+
+    def _append(self, kind, datecode, entries):
+        new_strings = []
+        payload = self._encode_rows(entries, new_strings)
+
+        records = []
+        if new_strings:
+            encoded = [string.encode("utf-8") for string in new_strings]
+            strings_payload = ROW_COUNT.pack(len(encoded)) + b"".join(
+                STRING_LENGTH.pack(len(string)) + string for string in encoded
+            )
+            records.append(("S", datecode, strings_payload))
+        records.append((kind, datecode, payload))
+
+        self.close()
+
+        with open(self.path, "r+b") as f:
+            # Records go where the old index was, followed by a fresh index and footer
+            f.seek(self._index_offset)
+            f.truncate()
+
+            for record_kind, record_datecode, record_payload in records:
+                offset = self._write_record(f, record_kind, record_datecode, record_payload)
+                if record_kind == "S":
+                    self.string_blocks.append((offset, len(record_payload)))
+                elif record_kind == "R":
+                    self.meta = [record_datecode]
+                    self.root = (offset, len(record_payload))
+                elif record_kind == "D":
+                    self.meta.append(record_datecode)
+                    self.deltas[record_datecode] = (offset, len(record_payload))
+                elif record_kind == "K":
+                    self.keyframes[record_datecode] = (offset, len(record_payload))
+
+            self._write_index(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._map()
+        self._read_index()
+
+    def _write_record(self, f, kind, datecode, payload):
+        """
+        :return: The offset of the payload
+        """
+        encoded_datecode = datecode.encode("ascii")
+        f.write(RECORD_KIND.pack(kind.encode("ascii"), len(encoded_datecode)))
+        f.write(encoded_datecode)
+        f.write(RECORD_LENGTH.pack(len(payload)))
+        offset = f.tell()
+        f.write(payload)
+        return offset
+
+    def _write_index(self, f):
+        index_offset = f.tell()
+
+        index = {
+            "meta": self.meta,
+            "root": self.root,
+            "deltas": self.deltas,
+            "keyframes": self.keyframes,
+            "strings": self.string_blocks,
+        }
+        self._write_record(f, "I", self.meta[-1], json.dumps(index).encode("utf-8"))
+        f.write(FOOTER.pack(index_offset, MAGIC))
+
+        self._index_offset = index_offset
+
+
+def pack_directory(directory, log=True):
+    """
+    Convert the loose files of a diff directory into {directory}/archive.pack
+
+    The loose files are left alone. Once the pack exists it is what
+    DiffEntryHistory.open and the pipeline use
+    """
+    deh = DiffEntryHistory.open(directory)
+    if deh.archive is not None:
+        raise ValueError(f"{directory} is already a packed or SQLite archive")
+
+    if log:
+        print(f"Packing {len(deh.meta)} days from {directory}...")
+
+    archive = PackedArchive.create(directory, deh.meta[0], deh.root)
+
+    for n, diff_el in enumerate(deh):
+        archive.append_delta(deh.meta[n + 1], diff_el)
+
+    for datecode in deh.keyframes:
+        if datecode in deh.meta[1:]:
+            archive.append_keyframe(datecode, deh.load_snapshot(datecode))
+
+    if log:
+        print(f"Packed archive saved to {archive.path}")
+
+    return archive
+
+
+def unpack_archive(directory, output_directory, log=True):
+    """
+    Write the packed archive in directory back out as loose files in output_directory
+    """
+    archive = PackedArchive.open(directory)
+
+    if not os.path.isdir(output_directory):
+        os.mkdir(output_directory)
+
+    if log:
+        print(f"Unpacking {len(archive.meta)} days into {output_directory}...")
+
+    meta = archive.meta
+
+    write_entries(f"{output_directory}/{meta[0]}.tsv", archive.read_snapshot(meta[0]))
+
+    for n in range(1, len(meta)):
+        write_entries(f"{output_directory}/{meta[n - 1]}-{meta[n]}.tsv", archive.read_delta(meta[n]).diff_entries)
+
+    for datecode in archive.keyframes:
+        DiffEntryHistory.save_keyframe(output_directory, datecode, archive.read_snapshot(datecode))
+
+    with open(f"{output_directory}/_meta.txt", "w+") as f:
+        f.write("\n".join(meta) + "\n")
+
+    archive.close()
+
+    if log:
+        print("Unpacking complete.")
@@ -1,20 +1,35 @@
 import datetime
 import os
+import shutil
+import tempfile
 
 from bpl_scraper import scrape_all_data
-from diffy import EntryList, DiffEntryHistory
+from compressed import compressed_name, file_exists, find_file
+from diffy import Entry, EntryList, DiffEntryHistory, DiffEntryList, KEYFRAME_INTERVAL, write_entries
+from indexes import DpsstIndex, MissingSummary, PresenceIndex
 
 
-def scrape_and_diff_today_from_yesterday(directory=None):
+def scrape_and_diff_today_from_yesterday(directory=None, keyframe_interval=KEYFRAME_INTERVAL, workers=None,
+                                         compression=None, scrape_workers=1, scrape_backend="selenium"):
+    """
+    Scrape today's data and record how it differs from the last day in the archive
+
+    :param keyframe_interval: How many days apart to save keyframes
+    :param workers: How many processes to difference with, see EntryList.diff
+    :param compression: An extension from compressed.CODECS to compress new scrape,
+    difference and keyframe files with. Files already on disk are read either way
+    :param scrape_workers: How many browsers to scrape with at once, see bpl_scraper.scrape_terms
+    :param scrape_backend: One of bpl_scraper.BACKENDS
+    """
     # Construct datecodes
     today = datetime.datetime.now()
 
     if not directory:
         directory = "repo"
 
-    # Get previous day from _meta file
-    with open(f"{directory}/diff/_meta.txt", "r") as f:
-        datecode0 = f.readlines()[-1].strip()
+    # Get previous day from the archive's meta, this doesn't load any data yet
+    diff_eh = DiffEntryHistory.open(f"{directory}/diff")
+    datecode0 = diff_eh.meta[-1]
 
     datecode1 = today.strftime("%Y%m%d")
 
@@ -23,16 +38,20 @@ def scrape_and_diff_today_from_yesterday(directory=None):
         return
 
     # Scrape from BPL site
-    if not os.path.exists(f"{directory}/scrape/{datecode1}.tsv"):
+    if not file_exists(f"{directory}/scrape/{datecode1}.tsv"):
         print("Scraping data...")
-        scrape_all_data(datecode=datecode1, directory="repo/scrape")
+        scrape_all_data(datecode=datecode1, directory="repo/scrape", compression=compression, workers=scrape_workers,
+                        backend=scrape_backend)
     else:
         print("Today's data has already been scraped.")
 
-    # Get EntryLists for differencing
-    el0 = DiffEntryHistory.open(f"{directory}/diff").rebuild()
+    # Get EntryLists for differencing, only rebuilding if the saved head can't be used
+    el0 = DiffEntryHistory.open_head(f"{directory}/diff", datecode0)
+    if el0 is None:
+        print("Head is missing or out of date, rebuilding...")
+        el0 = diff_eh.rebuild()
     el1 = EntryList.open(f"{directory}/scrape/{datecode1}.tsv")
-    diff = el0.diff(el1, log=True)
+    diff = el0.diff(el1, log=True, workers=workers)
 
     print(f"Removed since {datecode0[4:6]}/{datecode0[6:]}/{datecode0[:4]} (-):")
     print(str(diff[0]))
@@ -41,26 +60,47 @@ def scrape_and_diff_today_from_yesterday(directory=None):
     print(f"Added to {datecode1[4:6]}/{datecode1[6:]}/{datecode1[:4]} (+):")
     print(str(diff[1]))
 
-    diff_file = f"{directory}/diff/{datecode0}-{datecode1}.tsv"
+    # Changes to an existing DPSST number are stored as single modified records
+    diff_el = DiffEntryList.from_diff(diff[0], diff[1])
+
+    if diff_eh.archive is not None:
+        # Packed and SQLite archives keep the difference and the meta in the same file
+        diff_eh.archive.append_delta(datecode1, diff_el)
+
+        print(f"Difference saved to {diff_eh.archive.path}")
+    else:
+        diff_file = compressed_name(f"{directory}/diff/{datecode0}-{datecode1}.tsv", compression)
+        write_entries(diff_file, diff_el.diff_entries)
+
+        print(f"Difference saved to {diff_file}")
 
-    report_string = ""
+        # Update diff _meta file with new day
+        with open(f"{directory}/diff/_meta.txt", "a+") as f:
+            f.write(datecode1 + "\n")
 
-    for entry in diff[0]:
-        report_string += "-" + str(entry) + "\n"
+        print(f"Meta file updated with {datecode1}")
 
-    for entry in diff[1]:
-        report_string += "+" + str(entry) + "\n"
+    # Roll the head forward to today
+    el0.process_diff(diff_el)
+    DiffEntryHistory.save_head(f"{directory}/diff", datecode1, el0)
 
-    with open(diff_file, "w+") as f:
-        f.write(report_string)
+    print(f"Head updated to {datecode1}")
 
-    print(f"Difference saved to {diff_file}")
+    # Every so often, keep today's data around as a keyframe as well
+    if (len(diff_eh) + 1) % keyframe_interval == 0:
+        if diff_eh.archive is not None:
+            diff_eh.archive.append_keyframe(datecode1, el0)
+        else:
+            DiffEntryHistory.save_keyframe(f"{directory}/diff", datecode1, el0, compression)
 
-    # Update diff _meta file with new day
-    with open(f"{directory}/diff/_meta.txt", "a+") as f:
-        f.write(datecode1 + "\n")
+        print(f"Keyframe saved for {datecode1}")
 
-    print(f"Meta file updated with {datecode1}")
+    # Keep the indexes saved alongside the archive in step, each one building itself
+    # from scratch if it had fallen behind
+    for index_type in (DpsstIndex, MissingSummary, PresenceIndex):
+        index_type.roll_forward(f"{directory}/diff", diff_eh, datecode1, diff_el)
+
+        print(f"{index_type.__name__} updated to {datecode1}")
 
 
 def delete_old_tsv(directory=None):
@@ -80,8 +120,8 @@ def delete_old_tsv(directory=None):
 
     for n in range(1, len(eh.meta) - 2):
         diff_filename = create_filename(eh.meta[n - 1], eh.meta[n])
-        if os.path.exists(diff_filename):
-            del_filename = f"{directory}/scrape/{eh.meta[n]}.tsv"
+        if eh.archive is not None or file_exists(diff_filename):
+            del_filename = find_file(f"{directory}/scrape/{eh.meta[n]}.tsv")
             if os.path.exists(del_filename):
                 print(f"Deleting old TSV for {eh.meta[n]}")
                 os.remove(del_filename)
@@ -103,6 +143,92 @@ def test_partial_rebuilds(directory=None):
     print()
 
 
+def test_parallel_diff(directory=None, workers=4):
+    if not directory:
+        directory = "repo"
+
+    diff_eh = DiffEntryHistory.open(f"{directory}/diff")
+
+    el0 = diff_eh.rebuild(n=0)
+    el1 = diff_eh.rebuild()
+
+    serial = el0.diff(el1, log=False)
+    parallel = el0.diff(el1, log=False, workers=workers)
+
+    print(f"Serial: -{len(serial[0])} +{len(serial[1])}")
+    print(f"Parallel: -{len(parallel[0])} +{len(parallel[1])}")
+    print(f"Identical: {str(serial[0]) == str(parallel[0]) and str(serial[1]) == str(parallel[1])}")
+
+
+def test_batch_rebuild(directory=None):
+    if not directory:
+        directory = "repo"
+
+    diff_eh = DiffEntryHistory.open(f"{directory}/diff")
+
+    # One pass for every day, compared against rebuilding each day on its own
+    for datecode, el in diff_eh.rebuild_many():
+        rebuilt = DiffEntryHistory.open(f"{directory}/diff").rebuild(datecode=datecode)
+        print(f"{datecode}: {len(el)} entries, identical: {str(el) == str(rebuilt)}")
+
+
+def test_sqlite_backend(directory=None):
+    # Imported here since the pipeline itself never needs them
+    from sqlarchive import import_directory
+
+    if not directory:
+        directory = "repo"
+
+    # Import into a temporary directory so the original is still opened from its files
+    output_directory = tempfile.mkdtemp()
+
+    try:
+        import_directory(f"{directory}/diff", output_directory).close()
+
+        files = DiffEntryHistory.open(f"{directory}/diff")
+        sqlite = DiffEntryHistory.open(output_directory)
+
+        rebuilds = all(str(files.rebuild(n)) == str(sqlite.rebuild(n)) for n in range(len(files) + 1))
+        print(f"Rebuilds identical: {rebuilds}")
+
+        print(f"Missing entries identical: {str(files.count_presence()) == str(sqlite.count_presence())}")
+
+        dpsst_nums = [entry.dpsst_num for entry in files.rebuild()][:100]
+        lookups = all(
+            str(files.get_by_dpsst_num(dpsst_num)) == str(sqlite.get_by_dpsst_num(dpsst_num)) for dpsst_num in dpsst_nums
+        )
+        print(f"DPSST lookups identical: {lookups}")
+
+        sqlite.archive.close()
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+
+def test_fixture_replay(officers=1000, backend="http"):
+    # Imported here since the pipeline itself never needs them
+    from fixtures import record_corpus
+    from mock_bpl import MockBplServer, generate_officers, scraped_row
+
+    # Record made up officers, then scrape the recording back
+    work = tempfile.mkdtemp()
+
+    try:
+        served = generate_officers(officers)
+        with MockBplServer(served) as server:
+            record_corpus(f"{work}/corpus", url=server.url, log=False)
+
+        with MockBplServer(corpus=f"{work}/corpus") as server:
+            scrape_all_data("replay", f"{work}/scrape", url=server.url, backend=backend)
+
+        with open(f"{work}/scrape/replay.tsv", "r") as f:
+            replayed = f.read()
+
+        expected = "".join("\t".join(scraped_row(officer)) + "\n" for officer in served)
+        print(f"Identical to what was recorded: {replayed == expected}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
 def test_history_slicing(directory=None):
     if not directory:
         directory = "repo"
@@ -124,6 +250,31 @@ def test_history_slicing(directory=None):
     print()
 
 
+def test_presence_intervals(directory=None):
+    if not directory:
+        directory = "repo"
+
+    diff_eh = DiffEntryHistory.open(f"{directory}/diff")
+    presence = PresenceIndex.build(diff_eh)
+
+    as_of = all(str(presence.as_of(datecode)) == str(diff_eh.rebuild(n)) for n, datecode in enumerate(diff_eh.meta))
+    print(f"As of each day identical to rebuilds: {as_of}")
+
+    # Someone listed and delisted on the same day shouldn't show up at all
+    datecode = "99999999"
+    entry = Entry.from_fields("Nobody, Not A.", "00000", "Nowhere Police Department", "Police Officer", "Active")
+    day = DiffEntryList.from_diff([entry], [entry], modified=False)
+    presence.update(datecode, day)
+
+    listed = diff_eh.rebuild()
+    listed.process_diff(day)
+
+    print(f"Same day add and remove has no interval: {presence.intervals_for(entry) == []}")
+    print(f"As of that day identical to a rebuild: {str(presence.as_of(datecode)) == str(listed)}")
+    # Nothing else changed, so everything listed from the day before up to then is what's listed now
+    during = presence.during(diff_eh.meta[-1], datecode + "1")
+    print(f"During the days around it identical to a rebuild: {str(during) == str(listed)}")
+
 if __name__ == "__main__":
     scrape_and_diff_today_from_yesterday()
     delete_old_tsv()
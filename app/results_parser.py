@@ -0,0 +1,100 @@
+import html
+import re
+
+"""
+Reading a page of search results in one go.
+
+The page has two parts the scrapers care about, the ListTableAnyHeight grid
+with one row per officer, and the ListFooter pager below it. parse_results_page
+finds where each starts and reads straight through them, without splitting the
+page into lines or searching it again for each part.
+"""
+
+GRID = "ListTableAnyHeight"
+FOOTER = "ListFooter"
+
+# One officer: name, DPSST number and agency in the left-aligned cell and the two
+# after it, then rank and status in spans
+ROW = (
+    r'align="left"[^>]*>\s*<a[^>]*>(?P<name>[^<]*)</a>\s*</td>\s*'
+    r'<td[^>]*>(?P<dpsst_num>[^<]*)</td>\s*'
+    r'<td[^>]*>\s*(?:<a[^>]*>)?(?P<agency>[^<]*)(?:</a>)?\s*</td>\s*'
+    r'<td[^>]*>\s*<span[^>]*>(?P<rank>[^<]*)</span>\s*</td>\s*'
+    r'<td[^>]*>\s*<span[^>]*>(?P<status>[^<]*)</span>'
+)
+
+# In the pager, the page being shown isn't a link
+CURRENT_PAGE = r"<span>(?P<page>\d+)</span>"
+
+# The page's own source has &#39; for the quotes, a browser's has '
+TARGET = r"__doPostBack\((?:'|&#39;)(?P<target>[^'&]*)(?:'|&#39;),(?:'|&#39;)(?P<argument>Page\$(?P<page>\d+))(?:'|&#39;)\)"
+
+ROW_PATTERN = re.compile(ROW)
+CURRENT_PAGE_PATTERN = re.compile(CURRENT_PAGE)
+TARGET_PATTERN = re.compile(TARGET)
+
+
+def browser_text(text):
+    """
+    A browser gives back text with only &, < and > escaped, and non-breaking spaces as
+    &nbsp;, however the site escaped it. .NET sends apostrophes as &#39; for one
+    """
+    if "&" not in text and "\xa0" not in text:
+        return text
+    return html.escape(html.unescape(text), quote=False).replace("\xa0", "&nbsp;")
+
+
+class ResultsPage:
+    """
+    What's on a page of search results
+
+    rows: Each officer as [name, dpsst_num, agency, rank, status], with the text as a
+    browser shows it in the page source, which is how the scrapers save it
+    current_page: The page number being shown, or None if there's only one page
+    targets: A dict of page number: (event target, event argument) for each page the
+    pager links to, ellipses included, for posting back to get there
+    """
+
+    __slots__ = ("rows", "current_page", "targets")
+
+    def __init__(self, rows=None, current_page=None, targets=None):
+        self.rows = [] if rows is None else rows
+        self.current_page = current_page
+        self.targets = {} if targets is None else targets
+
+    def __repr__(self):
+        return f"ResultsPage({len(self.rows)} rows, page {self.current_page}, links to {sorted(self.targets)})"
+
+
+def parse_results_page(page):
+    """
+    :param page: The page's HTML
+    :return: A ResultsPage
+    """
+    # The grid runs up to the pager, or to the end if there's only one page
+    start = max(page.find(GRID), 0)
+    footer_start = page.find(FOOTER, start)
+    grid_end = len(page) if footer_start == -1 else footer_start
+
+    rows = []
+    for match in ROW_PATTERN.finditer(page, start, grid_end):
+        row = match.groups()
+        # Most fields have nothing escaped, so don't go through browser_text for them
+        rows.append([browser_text(value).strip() if "&" in value or "\xa0" in value else value.strip() for value in row])
+
+    if footer_start == -1:
+        return ResultsPage(rows)
+
+    # The pager is its own table inside the footer row
+    footer_end = page.find("</table>", footer_start)
+    if footer_end == -1:
+        footer_end = len(page)
+
+    current_page = CURRENT_PAGE_PATTERN.search(page, footer_start, footer_end)
+
+    targets = {}
+    for match in TARGET_PATTERN.finditer(page, footer_start, footer_end):
+        target, argument, page_number = match.group("target", "argument", "page")
+        targets[int(page_number)] = (target, argument)
+
+    return ResultsPage(rows, int(current_page.group("page")) if current_page else None, targets)
@@ -0,0 +1,436 @@
+import os
+import sqlite3
+import threading
+
+from diffy import Entry, EntryList, DiffEntry, DiffEntryList, DiffEntryHistory, LazyDiffEntryLists, ModifiedEntry, \
+    DIFF_CACHE_SIZE
+
+"""
+An archive kept in a SQLite database, so the history can be queried without
+loading it into Python.
+
+An archive.sqlite file has these tables:
+
+    strings     agency, rank and status values, which rows refer to by id
+    days        every datecode in order, and whether it has a keyframe
+    snapshots   the rows of the root and each keyframe, in order
+    events      the rows of each DiffEntryList, in order, with their mode
+    modified    which "-" rows in events start a modified record
+
+Modified records are stored as the "-" and "+" rows they stand for, so the
+queries only ever deal with those two. The modified table says where each pair
+is, so read_delta gives back the "~" record itself.
+
+SqliteHistory answers rebuild, get_by_dpsst_num and count_presence with a single
+query each. Each copy of an entry is ordered by where it came from: its position
+in the root, or the day and position of the "+" row that added it. A removal
+always takes the earliest copy still listed, so the k-th removal of an entry
+takes its k-th copy. An entry is listed as of a day if it has more copies than
+removals by then. Ordering what's left by origin gives the same EntryList the
+file-based rebuild does.
+"""
+
+SQLITE_FILENAME = "archive.sqlite"
+
+SCHEMA = """
+CREATE TABLE strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE days (
+    position INTEGER PRIMARY KEY,
+    datecode TEXT NOT NULL UNIQUE,
+    keyframe INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE snapshots (
+    datecode TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    dpsst_num TEXT NOT NULL,
+    agency INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    PRIMARY KEY (datecode, seq)
+);
+
+CREATE TABLE events (
+    datecode TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dpsst_num TEXT NOT NULL,
+    agency INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    PRIMARY KEY (datecode, seq)
+);
+
+CREATE TABLE modified (
+    datecode TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (datecode, seq)
+);
+
+CREATE INDEX snapshots_dpsst_num ON snapshots (dpsst_num);
+CREATE INDEX snapshots_agency ON snapshots (agency);
+CREATE INDEX events_dpsst_num ON events (dpsst_num);
+CREATE INDEX events_agency ON events (agency);
+"""
+
+# Every copy of an entry listed in the root or added up to :datecode, numbered per
+# entry by origin, alongside how many times each entry was removed by then.
+# {where} narrows both down, eg to a single DPSST number
+LISTED = """
+WITH copies AS (
+    SELECT datecode, seq, name, dpsst_num, agency, rank, status FROM snapshots
+    WHERE datecode = :root {where}
+    UNION ALL
+    SELECT datecode, seq, name, dpsst_num, agency, rank, status FROM events
+    WHERE mode = '+' AND datecode <= :datecode {where}
+),
+numbered AS (
+    SELECT *, ROW_NUMBER() OVER (
+        PARTITION BY name, dpsst_num, agency, rank ORDER BY datecode, seq
+    ) AS copy FROM copies
+),
+removals AS (
+    SELECT name, dpsst_num, agency, rank, COUNT(*) AS removed FROM events
+    WHERE mode = '-' AND datecode <= :datecode {where}
+    GROUP BY name, dpsst_num, agency, rank
+)
+SELECT numbered.name, numbered.dpsst_num, numbered.agency, numbered.rank, numbered.status
+FROM numbered LEFT JOIN removals USING (name, dpsst_num, agency, rank)
+WHERE numbered.copy > COALESCE(removals.removed, 0)
+ORDER BY numbered.datecode, numbered.seq
+"""
+
+# The representative entry of every DPSST number added as many times as it was
+# removed up to :datecode, in order of first appearance. See indexes.MissingSummary
+MISSING = """
+WITH everything AS (
+    SELECT datecode, seq, '+' AS mode, name, dpsst_num, agency, rank, status FROM snapshots
+    WHERE datecode = :root
+    UNION ALL
+    SELECT datecode, seq, mode, name, dpsst_num, agency, rank, status FROM events
+    WHERE datecode <= :datecode
+),
+ranked AS (
+    SELECT *,
+        SUM(mode = '+') OVER (PARTITION BY dpsst_num) AS added,
+        SUM(mode = '-') OVER (PARTITION BY dpsst_num) AS removed,
+        ROW_NUMBER() OVER (
+            PARTITION BY dpsst_num ORDER BY mode != '+', agency IS NOT :preferred, datecode, seq
+        ) AS preference,
+        FIRST_VALUE(datecode) OVER (PARTITION BY dpsst_num ORDER BY datecode, seq) AS first_datecode,
+        FIRST_VALUE(seq) OVER (PARTITION BY dpsst_num ORDER BY datecode, seq) AS first_seq
+    FROM everything
+)
+SELECT name, dpsst_num, agency, rank, status FROM ranked
+WHERE preference = 1 AND added = removed
+ORDER BY first_datecode, first_seq
+"""
+
+
+class SqliteArchive:
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = []
+        self.keyframes = []
+
+        # id: value, and back again
+        self.strings = {}
+        self.codes = {}
+
+        # Each thread gets its own connection, see connection
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """
+        This thread's connection to the database. A sqlite3 connection can only be used
+        from the thread that made it, and the web app reads the archive from waitress's
+        worker threads
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Only ever used from this thread, but close() may come from another
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isfile(f"{directory}/{SQLITE_FILENAME}")
+
+    @staticmethod
+    def open(directory):
+        """
+        Open the SQLite archive in directory, reading only the days and strings
+        """
+        archive = SqliteArchive(f"{directory}/{SQLITE_FILENAME}")
+
+        for datecode, keyframe in archive.connection.execute("SELECT datecode, keyframe FROM days ORDER BY position"):
+            archive.meta.append(datecode)
+            if keyframe:
+                archive.keyframes.append(datecode)
+
+        for code, value in archive.connection.execute("SELECT id, value FROM strings"):
+            archive.strings[code] = value
+            archive.codes[value] = code
+
+        return archive
+
+    @staticmethod
+    def create(directory, root_datecode, root):
+        """
+        Start a new SQLite archive in directory holding only a root snapshot
+        """
+        path = f"{directory}/{SQLITE_FILENAME}"
+        if os.path.exists(path):
+            raise ValueError(f"Won't overwrite existing archive {path}")
+
+        archive = SqliteArchive(path)
+
+        with archive.connection:
+            archive.connection.executescript(SCHEMA)
+            archive.connection.execute("INSERT INTO days (position, datecode) VALUES (0, ?)", (root_datecode,))
+            archive._insert_rows("snapshots", root_datecode, root)
+
+        archive.meta.append(root_datecode)
+        return archive
+
+    def close(self):
+        """
+        Close every thread's connection. Using the archive again opens new ones
+        """
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._local = threading.local()
+
+    def history(self, cache_size=DIFF_CACHE_SIZE):
+        """
+        A SqliteHistory reading lazily from this archive
+        """
+        data = LazyDiffEntryLists(self.meta[1:], load=self.read_delta, cache_size=cache_size)
+        directory = os.path.dirname(self.path)
+        return SqliteHistory(
+            root=None, meta=list(self.meta), data=data, directory=directory,
+            keyframes=list(self.keyframes), archive=self
+        )
+
+    def read_snapshot(self, datecode):
+        """
+        Read the root or a keyframe as an EntryList
+        """
+        if datecode != self.meta[0] and datecode not in self.keyframes:
+            raise ValueError(f"No snapshot for {datecode} in {self.path}")
+
+        rows = self.connection.execute(
+            "SELECT name, dpsst_num, agency, rank, status FROM snapshots WHERE datecode = ? ORDER BY seq",
+            (datecode,)
+        )
+        return EntryList([self._entry(Entry, row) for row in rows])
+
+    def read_delta(self, datecode):
+        """
+        Read the DiffEntryList which ends at datecode
+        """
+        if datecode not in self.meta[1:]:
+            raise ValueError(f"No DiffEntryList for {datecode} in {self.path}")
+
+        modified = {seq for seq, in self.connection.execute("SELECT seq FROM modified WHERE datecode = ?", (datecode,))}
+        rows = self.connection.execute(
+            "SELECT seq, mode, name, dpsst_num, agency, rank, status FROM events WHERE datecode = ? ORDER BY seq",
+            (datecode,)
+        )
+
+        output = DiffEntryList()
+        old = None
+        for row in rows:
+            diff_entry = self._entry(DiffEntry, row[2:])
+            diff_entry.mode = row[1]
+
+            # The "+" row straight after a modified "-" row is the other half of it
+            if row[0] in modified:
+                old = diff_entry
+            elif old is not None:
+                output.append(ModifiedEntry.from_pair(old, diff_entry))
+                old = None
+            else:
+                output.append(diff_entry)
+        return output
+
+    def append_delta(self, datecode, diff_el):
+        """
+        Add the next day's DiffEntryList to the end of the archive
+        """
+        if datecode in self.meta:
+            raise ValueError(f"Datecode {datecode} is already in {self.path}")
+
+        events = []
+        modified = []
+        for diff_entry in diff_el.diff_entries:
+            if diff_entry.mode == "~":
+                modified.append((datecode, len(events)))
+                events += diff_entry.split()
+            else:
+                events.append(diff_entry)
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO days (position, datecode) VALUES (?, ?)", (len(self.meta), datecode)
+            )
+            self.connection.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(datecode, seq, diff_entry.mode) + self._row(diff_entry) for seq, diff_entry in enumerate(events)]
+            )
+            self.connection.executemany("INSERT INTO modified VALUES (?, ?)", modified)
+
+        self.meta.append(datecode)
+
+    def append_keyframe(self, datecode, entry_list):
+        if datecode not in self.meta:
+            raise ValueError(f"Datecode {datecode} not in {self.path}")
+
+        with self.connection:
+            self.connection.execute("DELETE FROM snapshots WHERE datecode = ?", (datecode,))
+            self._insert_rows("snapshots", datecode, entry_list)
+            self.connection.execute("UPDATE days SET keyframe = 1 WHERE datecode = ?", (datecode,))
+
+        if datecode not in self.keyframes:
+            self.keyframes.append(datecode)
+
+    def listed(self, datecode, dpsst_num=None):
+        """
+        Everything listed as of datecode, straight from the database
+
+        :param dpsst_num: Only look at this DPSST number
+        """
+        parameters = {"root": self.meta[0], "datecode": datecode}
+        where = ""
+        if dpsst_num is not None:
+            parameters["dpsst_num"] = dpsst_num
+            where = "AND dpsst_num = :dpsst_num"
+
+        rows = self.connection.execute(LISTED.format(where=where), parameters)
+        return EntryList([self._entry(Entry, row) for row in rows])
+
+    def missing(self, datecode):
+        """
+        The representative entry of every DPSST number missing as of datecode, the
+        same as indexes.MissingSummary would give
+        """
+        parameters = {
+            "root": self.meta[0],
+            "datecode": datecode,
+            "preferred": self.codes.get("Portland Police Bureau")
+        }
+
+        rows = self.connection.execute(MISSING, parameters)
+        return EntryList([self._entry(Entry, row) for row in rows])
+
+    def _code(self, value):
+        if value not in self.codes:
+            cursor = self.connection.execute("INSERT INTO strings (value) VALUES (?)", (value,))
+            self.codes[value] = cursor.lastrowid
+            self.strings[cursor.lastrowid] = value
+        return self.codes[value]
+
+    def _row(self, entry):
+        return entry.name, entry.dpsst_num, self._code(entry.agency), self._code(entry.rank), self._code(entry.status)
+
+    def _entry(self, entry_type, row):
+        name, dpsst_num, agency, rank, status = row
+        return entry_type.from_fields(name, dpsst_num, self.strings[agency], self.strings[rank], self.strings[status])
+
+    def _insert_rows(self, table, datecode, entries):
+        self.connection.executemany(
+            f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(datecode, seq) + self._row(entry) for seq, entry in enumerate(entries)]
+        )
+
+
+class SqliteHistory(DiffEntryHistory):
+    """
+    A DiffEntryHistory backed by a SqliteArchive, which answers rebuild,
+    get_by_dpsst_num and count_presence in SQL rather than by replaying
+    DiffEntryLists. Everything else works the same as for any other history
+    """
+
+    def _datecode(self, n, datecode):
+        if datecode:
+            if datecode not in self.meta:
+                raise ValueError(f"Datecode {datecode} not in this DiffEntryHistory")
+            return datecode
+
+        if n == -1:
+            n = len(self)
+        n = min(max(n, 0), len(self))
+        return self.meta[n] if n < len(self.meta) else None
+
+    def rebuild(self, n=-1, datecode=None):
+        datecode = self._datecode(n, datecode)
+        if datecode is None:
+            return super().rebuild(n)
+
+        cached = self.cache.get(datecode)
+        if cached is not None:
+            return cached
+
+        output = self.archive.listed(datecode)
+        self.cache.put(datecode, output)
+        return output
+
+    def get_by_dpsst_num(self, dpsst_num, n=-1, datecode=None):
+        return self.archive.listed(self._datecode(n, datecode), dpsst_num)
+
+    def count_presence(self):
+        # A slice starts from a rebuilt day rather than the archive's root
+        if self.meta[0] != self.archive.meta[0]:
+            return super().count_presence()
+        return self.archive.missing(self.meta[-1])
+
+
+def import_directory(directory, output_directory=None, log=True):
+    """
+    Copy the archive in directory, loose files or packed, into an archive.sqlite
+
+    The original is left alone. Once archive.sqlite exists it is what
+    DiffEntryHistory.open and the pipeline use
+
+    :param output_directory: Where to put archive.sqlite, defaults to directory
+    """
+    deh = DiffEntryHistory.open(directory)
+    if isinstance(deh.archive, SqliteArchive):
+        raise ValueError(f"{directory} is already a SQLite archive")
+
+    if not output_directory:
+        output_directory = directory
+    elif not os.path.isdir(output_directory):
+        os.mkdir(output_directory)
+
+    if log:
+        print(f"Importing {len(deh.meta)} days from {directory}...")
+
+    archive = SqliteArchive.create(output_directory, deh.meta[0], deh.root)
+
+    for n, diff_el in enumerate(deh):
+        archive.append_delta(deh.meta[n + 1], diff_el)
+
+    for datecode in deh.keyframes:
+        if datecode in deh.meta[1:]:
+            archive.append_keyframe(datecode, deh.load_snapshot(datecode))
+
+    if log:
+        print(f"SQLite archive saved to {archive.path}")
+
+    return archive
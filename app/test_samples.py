@@ -7,43 +7,19 @@ to do things with your DiffEntryHistory
 
 
 def count_active_in_areas(diffentryhistory):
-    output = 0
     areas = ("multnomah", "clackamas")
 
-    # rebuild produces an EntryList, which does not contain differencing information
-    entrylist = diffentryhistory.rebuild(-1)
-
-    for entry in entrylist:
-        if entry.status == "Active" and any(area in entry.agency.lower() for area in areas):
-            output += 1
-
-    return output
+    # Queries run against the rebuilt EntryList, which does not contain differencing information
+    return diffentryhistory.count(status="Active", agency__icontains=areas)
 
 
 def count_active_dispatchers(diffentryhistory):
-    output = 0
-
-    entrylist = diffentryhistory.rebuild(-1)
-
-    for entry in entrylist:
-        if entry.rank.lower() == "dispatcher" and entry.status == "Active":
-            output += 1
-
-    return output
+    return diffentryhistory.count(rank__ieq="dispatcher", status="Active")
 
 
 def count_inactive(diffentryhistory):
-    output = 0
-    names = []
-
-    entrylist = diffentryhistory.rebuild(-1)
-
-    for entry in entrylist:
-        if entry.status == "Inactive" and entry.name not in names:
-            output += 1
-            names.append(entry.name)
-
-    return output
+    # Grouping by name counts each name once
+    return len(diffentryhistory.group_by("name", status="Inactive"))
 
 
 def test_rebuild_with_datecode_argument(diffentryhistory):